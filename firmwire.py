@@ -11,6 +11,7 @@ import firmwire
 from firmwire.util.param import ParamValidator
 from firmwire.util.misc import arg_snapshot, download_url
 from firmwire.emulator.init import MachineInitParams
+from firmwire.emulator.logwriter import AsyncLogWriter, create_log_writer
 from _version import __version__
 
 log = logging.getLogger("firmwire")
@@ -67,6 +68,13 @@ def get_args():
     parser.add_argument(
         "--restore-snapshot", type=str, help="Restore a snapshot by name"
     )
+    parser.add_argument(
+        "--snapshot-pool",
+        type=int,
+        default=0,
+        metavar="N",
+        help="Keep up to N snapshots of RAM, registers and peripherals in memory instead of the workspace for fast restores (e.g. from the console). They are lost on exit",
+    )
     parser.add_argument(
         "--consecutive-ports",
         **MachineInitParams.param_arg_spec("--consecutive-ports"),
@@ -168,6 +176,62 @@ def get_args():
         action="store_true",
         help="Print the address of each new basic block, useful to see BBs reached during fuzzing.",
     )
+    devopts.add_argument(
+        "--guest-log",
+        type=str,
+        help="Write guest log lines to this file instead of stdout.",
+    )
+    devopts.add_argument(
+        "--guest-log-max-size",
+        type=int,
+        default=0,
+        help="Rotate the --guest-log file once it exceeds this size in MiB (keeps 3 old files).",
+    )
+    devopts.add_argument(
+        "--guest-log-buffer",
+        type=int,
+        default=0x10000,
+        help="Number of guest log lines buffered by the background writer before the emulator blocks or drops lines. Default is %(default)d.",
+    )
+    devopts.add_argument(
+        "--guest-log-policy",
+        choices=AsyncLogWriter.POLICIES,
+        default="block",
+        help="What to do when the background writer's buffer is full. Default is %(default)s.",
+    )
+    guest_log_mode = devopts.add_mutually_exclusive_group()
+    guest_log_mode.add_argument(
+        "--guest-log-sync",
+        action="store_true",
+        help="Write --guest-log lines synchronously from the emulation thread. Lines written to stdout are synchronous unless --guest-log-async is given.",
+    )
+    guest_log_mode.add_argument(
+        "--guest-log-async",
+        action="store_true",
+        help="Write guest log lines to stdout from a background thread, so the emulator does not wait for the terminal or pipe. Guest lines may then interleave out of order with FirmWire's own log output.",
+    )
+    devopts.add_argument(
+        "--guest-log-suppress",
+        action="store_true",
+        help="(Shannon only) Patch out guest log calls whose output is banned or from disabled tasks.",
+    )
+    devopts.add_argument(
+        "--guest-log-capture",
+        type=str,
+        help="(Shannon only) Capture log_printf calls to this binary file instead of formatting them. Decode with python -m firmwire.vendor.shannon.tracecapture.",
+    )
+    devopts.add_argument(
+        "--log-stats-interval",
+        type=float,
+        default=0.0,
+        help="Write log volume statistics (per task, log callsite and peripheral) to ${workspace}/log_stats.json every N seconds. Default is 0 (disabled).",
+    )
+    devopts.add_argument(
+        "--log-stats-top",
+        type=int,
+        default=0,
+        help="Print this many of the top tasks, callsites and peripherals of the log statistics at shutdown. Default is 0 (disabled).",
+    )
     parser.add_argument(
         "--full-coverage",
         action="store_true",
@@ -236,7 +300,24 @@ def main() -> int:
         log.error("Failed to load firmware")
         return 1
 
+    # stdout is synchronous and files asynchronous unless asked otherwise
+    guest_log_sync = None
+
+    if args.guest_log_sync:
+        guest_log_sync = True
+    elif args.guest_log_async:
+        guest_log_sync = False
+
     machine = loader.get_machine()
+    machine.guest_logger.set_output(
+        create_log_writer(
+            path=args.guest_log,
+            max_size=args.guest_log_max_size * 1024 * 1024,
+            capacity=args.guest_log_buffer,
+            policy=args.guest_log_policy,
+            sync=guest_log_sync,
+        )
+    )
     machine.modkit.append_search_path("./modkit/%s/build" % (loader.NAME))
     machine.modkit.append_search_path("./")
 
@@ -248,9 +329,37 @@ def main() -> int:
 
     log.info("Machine initialization time took %.2f seconds", machine.time_running())
 
+    if args.snapshot_pool > 0:
+        if args.restore_snapshot:
+            log.error("--restore-snapshot needs a snapshot from the workspace, not --snapshot-pool")
+            return 1
+
+        machine.snapshot_pool_enable(args.snapshot_pool)
+
     if args.restore_snapshot:
         machine.restore_snapshot(args.restore_snapshot)
 
+    if args.guest_log_capture:
+        if not hasattr(machine, "log_capture_enable"):
+            log.error("--guest-log-capture is not supported by %s", loader.NAME)
+            return 1
+
+        machine.log_capture_enable(args.guest_log_capture)
+
+    if args.guest_log_suppress:
+        if not hasattr(machine, "log_suppression_enable"):
+            log.error("--guest-log-suppress is not supported by %s", loader.NAME)
+            return 1
+
+        machine.log_suppression_enable()
+
+    machine.log_stats_top = args.log_stats_top
+
+    if args.log_stats_interval > 0:
+        machine.log_stats.start_dump(
+            workspace.path("/log_stats.json").to_path(), args.log_stats_interval
+        )
+
     # MUST come after initialization (needs a valid QEMU instance)
     if args.snapshot_at:
         machine.snapshot_state_at_address(
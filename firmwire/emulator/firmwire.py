@@ -11,7 +11,7 @@ from types import MethodType  # Panda unassigned access
 
 from ..modkit import ModKit
 from .guestlogs import FirmWireGuestLogger
-from .snapshot import QemuSnapshotManager
+from .snapshot import QemuSnapshotManager, RamSnapshotPool
 from ..hw.soc import SOCPeripheral
 
 from firmwire.util.misc import copy_function
@@ -44,6 +44,9 @@ class FirmWireEmu(ABC):
         self._bp_map = {}
         self.peripheral_map = {}
         self.guest_logger = FirmWireGuestLogger(self)
+        self.log_stats = self.guest_logger.stats
+        # tasks, callsites and peripherals printed at shutdown (0 for none)
+        self.log_stats_top = 0
 
         self.signal_count = 0
         self.start_time = None
@@ -202,11 +205,19 @@ class FirmWireEmu(ABC):
             if not (self.qemu.state & TargetStates.STOPPED):
                 self.qemu.stop()
 
+            self.guest_logger.flush()
+
             import IPython
 
             IPython.embed()
 
         print("==> SHUTDOWN")
+        self.guest_logger.flush()
+        self.log_stats.stop_dump()
+
+        if self.log_stats_top > 0:
+            self.log_stats.print_table(top=self.log_stats_top)
+
         avatar.shutdown()
 
     def install_hooks(self, mappings):
@@ -435,9 +446,15 @@ class FirmWireEmu(ABC):
             log.info("Resuming...")
             self.qemu.cont(blocking=False)
 
+    def snapshot_pool_enable(self, size):
+        """Keep up to size snapshots in memory instead of snapshots.qcow2"""
+        self.snapshot_manager = RamSnapshotPool(self, size)
+        log.info("Snapshots are kept in memory (up to %d)", size)
+
     def restore_snapshot(self, snapshot_name):
         assert self.qemu.state & TargetStates.STOPPED
 
+        start = time.time()
         self.pre_snapshot_restore_handler(snapshot_name)
 
         result = self.snapshot_manager.restore(
@@ -481,6 +498,9 @@ class FirmWireEmu(ABC):
 
         self.post_snapshot_restore_handler(snapshot_name, result, machine_state)
 
+        log.info(
+            "Restored snapshot %s in %.3f seconds", snapshot_name, time.time() - start
+        )
         self.snapshot_manager.print_info(snapshot_name)
 
     def apply_memory_map(self, memory_map: list[MemoryMapEntry]):
@@ -697,6 +717,7 @@ class FirmWireEmu(ABC):
         # keep above avatar calls since they may not return
         if self.signal_count >= 2:
             log.critical("Force exit by user")
+            self.guest_logger.flush(timeout=1)
             os._exit(1)
 
         if self.qemu and self.qemu.state == TargetStates.RUNNING:
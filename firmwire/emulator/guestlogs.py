@@ -2,12 +2,151 @@
 ## SPDX-License-Identifier: BSD-3-Clause
 import re
 
+from .logwriter import SyncLogWriter, StdoutSink
+from .logstats import LogStats
+
+
+class LogBanMatcher:
+    """
+    Ban patterns in order of addition, checked with as few scans as possible
+
+    Literal patterns are found with substring checks. Regular expressions
+    without groups are joined into one alternation, so a line which matches
+    nothing (nearly all of them) costs one search. Only if something matched
+    are the patterns tried one by one, so the first pattern that matches is
+    reported, as when checking each pattern in turn.
+    """
+
+    def __init__(self):
+        # (pattern, literal string or None, compiled regex or None)
+        self.patterns = []
+        self.hits = {}
+
+        self._literals = []
+        self._regexes = []
+        self._combined = None
+
+    def add(self, pattern, literal=False):
+        """Add a regular expression, or a plain string if literal is set"""
+        if literal:
+            string, pattern = pattern, re.escape(pattern)
+        elif re.escape(pattern) == pattern:
+            string = pattern
+        else:
+            string = None
+
+        if string is not None:
+            self.patterns.append((pattern, string, None))
+            self._literals.append(string)
+        else:
+            pat = re.compile(pattern)
+            self.patterns.append((pattern, None, pat))
+            self._regexes.append(pat)
+            self._combined = None
+
+        self.hits.setdefault(pattern, 0)
+
+    def __len__(self):
+        return len(self.patterns)
+
+    def _compile(self):
+        # group numbers and names would clash in an alternation
+        simple = [pat for pat in self._regexes if pat.groups == 0]
+        grouped = [pat for pat in self._regexes if pat.groups > 0]
+
+        if len(simple) > 1:
+            try:
+                simple = [
+                    re.compile("|".join(["(?:%s)" % pat.pattern for pat in simple]))
+                ]
+            except re.error:
+                # e.g. inline flags, which have to stay at the start of a pattern
+                pass
+
+        self._combined = simple + grouped
+
+    def _matches(self, msg):
+        for literal in self._literals:
+            if literal in msg:
+                return True
+
+        if not self._regexes:
+            return False
+
+        if self._combined is None:
+            self._compile()
+
+        for pat in self._combined:
+            if pat.search(msg):
+                return True
+
+        return False
+
+    def match(self, msg):
+        """The first pattern which matches msg or None. Counts the hit"""
+        if not self._matches(msg):
+            return None
+
+        for pattern, string, pat in self.patterns:
+            if (string in msg) if pat is None else pat.search(msg):
+                self.hits[pattern] += 1
+                return pattern
+
+        return None
+
 
 class FirmWireGuestLogger:
     def __init__(self, machine):
         self._machine = machine
+        # in order with the other log output (see create_log_writer)
+        self._output = SyncLogWriter(StdoutSink())
+        self._listeners = []
+        # kept across reset()
+        self.stats = LogStats(machine)
         self.reset()
 
+    def set_output(self, writer):
+        """Replace the log writer (see firmwire.emulator.logwriter). The old one is closed"""
+        old = self._output
+        self._output = writer
+        old.close()
+
+    @property
+    def dropped_lines(self):
+        return self._output.dropped
+
+    def flush(self, timeout=None):
+        """Wait until all guest log lines have been written"""
+        return self._output.flush(timeout=timeout)
+
+    def add_listener(self, listener):
+        """
+        Tell listener about lines which will stay omitted
+
+        listener.log_muted(address, reason) is called when lines logged from
+        address are omitted because the address is banned (reason "ban") or
+        because all tasks are disabled (reason "task").
+        listener.log_filters_changed() is called after the task filters or the
+        bans changed. Muted addresses may log again.
+        """
+        self._listeners.append(listener)
+
+    def remove_listener(self, listener):
+        self._listeners.remove(listener)
+
+    def _filters_changed(self):
+        for listener in self._listeners:
+            listener.log_filters_changed()
+
+    def ban_address(self, address):
+        self._banned_addresses.add(address)
+
+        for listener in self._listeners:
+            listener.log_muted(address, "ban")
+
+    def address_banned(self, address):
+        return address in self._banned_addresses
+
     def reset(self):
         # None = all, {} = no logging, "name" in {...} = "name" enabled
         self._tasks_enabled = None
@@ -20,15 +159,24 @@ class FirmWireGuestLogger:
 
         self._banned_addresses = set()
         self._banned_log_hashes = set()
-        self._banned_log_patterns = []
+        self._ban_matcher = LogBanMatcher()
+        # addresses whose lines were checked against the ban patterns
+        self._ban_checked_addresses = set()
+
+        self._filters_changed()
 
     def add_ban_pattern(self, pattern):
-        pat = re.compile(pattern)
-        self._banned_log_patterns.append(pat)
+        self._ban_matcher.add(pattern)
+        self._ban_checked_addresses.clear()
 
     def add_ban_string(self, string):
-        pat = re.compile(re.escape(string))
-        self._banned_log_patterns.append(pat)
+        self._ban_matcher.add(string, literal=True)
+        self._ban_checked_addresses.clear()
+
+    @property
+    def ban_pattern_hits(self):
+        """How many log lines (and thereby addresses) each ban pattern matched"""
+        return dict(self._ban_matcher.hits)
 
     def log_emit(self, fmt, *args, **meta):
         task_name = meta.get("task_name", None)
@@ -52,6 +200,9 @@ class FirmWireGuestLogger:
             and address not in self._banned_addresses
             and log_hash not in self._banned_log_hashes
         ):
+            if self.stats.enabled:
+                self.stats.count_line(task_name, address, False)
+
             if self._disabled_streak > 0:
                 self._write(
                     ("[%.5f] %d total log lines omitted [%s]")
@@ -91,13 +242,11 @@ class FirmWireGuestLogger:
                 if address is not None:
                     location = "0x%x" % address
 
-                    sym = self._machine.symbol_table.lookup(address)
+                    sym = self._machine.symbol_table.symbolize(address)
 
                     if sym is not None:
                         offset = address - sym.address
-
-                        if abs(offset) < 0x1000:
-                            location = sym.format(offset) + " (%s)" % location
+                        location = sym.format(offset) + " (%s)" % location
 
                     self._write(
                         ("[%.5f][%s] %s %s")
@@ -109,25 +258,42 @@ class FirmWireGuestLogger:
                         % (self._machine.time_running(), task_name, this_msg)
                     )
 
-            for vibe_check in self._banned_log_patterns:
-                if vibe_check.search(this_msg):
+            # each address is checked once, with the first line it logs
+            if self._ban_matcher.patterns and (
+                address is None or address not in self._ban_checked_addresses
+            ):
+                vibe_check = self._ban_matcher.match(this_msg)
+
+                if address is not None:
+                    self._ban_checked_addresses.add(address)
+
+                if vibe_check is not None:
                     if address is not None:
-                        self._banned_addresses.add(address)
+                        self.ban_address(address)
 
                     if log_hash is not None:
                         self._banned_log_hashes.add(log_hash)
 
                     self._write(
                         ("[%.5f] last message matched ban pattern '%s'")
-                        % (self._machine.time_running(), vibe_check.pattern)
+                        % (self._machine.time_running(), vibe_check)
                     )
-                    break
 
             self._last_msg = this_msg
         else:
+            if self.stats.enabled:
+                self.stats.count_line(task_name, address, True)
             self._disabled_streak += 1
             self._skipped_names[task_name] = self._skipped_names.get(task_name, 0) + 1
 
+            if self._listeners and address is not None:
+                if address in self._banned_addresses:
+                    for listener in self._listeners:
+                        listener.log_muted(address, "ban")
+                elif self._tasks_enabled is not None and not self._tasks_enabled:
+                    for listener in self._listeners:
+                        listener.log_muted(address, "task")
+
             if (self._disabled_streak % 1000) == 0:
                 self._write(
                     ("[%.5f] %d log lines omitted [%s]")
@@ -146,9 +312,11 @@ class FirmWireGuestLogger:
 
     def task_log_enable_all(self):
         self._tasks_enabled = None
+        self._filters_changed()
 
     def task_log_disable_all(self):
         self._tasks_enabled = set()
+        self._filters_changed()
 
     def task_log_enable(self, *tasks):
         if self._tasks_enabled is None:
@@ -157,12 +325,16 @@ class FirmWireGuestLogger:
         for task_name in tasks:
             self._tasks_enabled.add(task_name)
 
+        self._filters_changed()
+
     def task_log_exclusive(self, *tasks):
-        self.task_log_disable_all()
+        self._tasks_enabled = set()
 
         for task_name in tasks:
             self._tasks_enabled.add(task_name)
 
+        self._filters_changed()
+
     def task_log_disable(self, *tasks):
         if self._tasks_enabled is None:
             return
@@ -170,6 +342,8 @@ class FirmWireGuestLogger:
         for task_name in tasks:
             self._tasks_enabled.discard(task_name)
 
+        self._filters_changed()
+
     def _format_skipped_report(self):
         MAX_NAME = 10
         sorted_skipped = sorted(
@@ -185,4 +359,4 @@ class FirmWireGuestLogger:
         )
 
     def _write(self, logdata):
-        print(logdata)
+        self._output.write(logdata)
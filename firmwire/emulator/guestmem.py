@@ -0,0 +1,89 @@
+## Copyright (c) 2022, Team FirmWire
+## SPDX-License-Identifier: BSD-3-Clause
+import struct
+from contextlib import contextmanager
+
+
+class GuestMemory:
+    """
+    Bulk reads of guest physical memory through PANDA
+
+    Strings are read in aligned chunks which are scanned for the NUL, instead
+    of with one PANDA call per byte. Inside of block_cache(), chunks are kept
+    until the block is left. Hooks run while the guest is stopped at a basic
+    block, so their reads of arguments and strings can share chunks.
+    """
+
+    CHUNK_SIZE = 0x80
+
+    def __init__(self, panda, cache=True):
+        self.panda = panda
+        self.cache = cache
+        self._chunks = None
+
+    @contextmanager
+    def block_cache(self):
+        # nested blocks share the outer cache
+        if not self.cache or self._chunks is not None:
+            yield self
+            return
+
+        self._chunks = {}
+
+        try:
+            yield self
+        finally:
+            self._chunks = None
+
+    def read(self, address, size):
+        if self._chunks is None:
+            return self.panda.physical_memory_read(address, size)
+
+        chunk_address = address - address % self.CHUNK_SIZE
+        data = []
+
+        while chunk_address < address + size:
+            chunk = self._chunks.get(chunk_address)
+
+            if chunk is None:
+                chunk = self.panda.physical_memory_read(chunk_address, self.CHUNK_SIZE)
+                self._chunks[chunk_address] = chunk
+
+            data.append(chunk)
+            chunk_address += self.CHUNK_SIZE
+
+        offset = address % self.CHUNK_SIZE
+        return b"".join(data)[offset : offset + size]
+
+    def read_u32s(self, address, count):
+        """count little endian words starting at address"""
+        return list(struct.unpack("<%dI" % count, self.read(address, 4 * count)))
+
+    def read_cstring(self, address):
+        """The bytes from address to the next NUL (not included)"""
+        parts = []
+
+        while True:
+            size = self.CHUNK_SIZE - address % self.CHUNK_SIZE
+
+            try:
+                chunk = self.read(address, size)
+            except ValueError:
+                # the chunk is partially unmapped, fail at the same byte as a bytewise read
+                chunk = b""
+
+                while len(chunk) < size:
+                    c = self.panda.physical_memory_read(address + len(chunk), 1)
+                    chunk += c
+
+                    if c == b"\x00":
+                        break
+
+            end = chunk.find(b"\x00")
+
+            if end >= 0:
+                parts.append(chunk[:end])
+                return b"".join(parts)
+
+            parts.append(chunk)
+            address += size
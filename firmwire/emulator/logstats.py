@@ -0,0 +1,210 @@
+## Copyright (c) 2022, Team FirmWire
+## SPDX-License-Identifier: BSD-3-Clause
+import os
+import json
+import logging
+import threading
+
+log = logging.getLogger(__name__)
+
+
+class LogStats:
+    """
+    Counters of the log volume while emulating
+
+    Guest log lines are counted per (task name, caller address), split into
+    emitted and omitted lines. Peripheral accesses are counted per peripheral
+    name. Counting is a dict lookup and always on, so that a slow boot can be
+    looked into afterwards (clear `enabled` to stop it). Symbols are only
+    resolved by snapshot(). Periodic dumps and the shutdown table are opt-in.
+    """
+
+    def __init__(self, machine):
+        self._machine = machine
+        self.enabled = True
+        self._dump_thread = None
+        self._dump_stop = threading.Event()
+        self.reset()
+
+    def reset(self):
+        # (task name, address) -> [emitted, omitted]
+        self._lines = {}
+        # peripheral name -> [reads, writes]
+        self._peripherals = {}
+
+    def count_line(self, task_name, address, omitted):
+        counts = self._lines.get((task_name, address))
+
+        if counts is None:
+            counts = self._lines[(task_name, address)] = [0, 0]
+
+        counts[omitted] += 1
+
+    def count_peripheral(self, name, write):
+        counts = self._peripherals.get(name)
+
+        if counts is None:
+            counts = self._peripherals[name] = [0, 0]
+
+        counts[write] += 1
+
+    def _symbolize(self, callsites):
+        """Set the symbol of each callsite, all symbols are looked up in one batch"""
+        symbol_table = getattr(self._machine, "symbol_table", None)
+
+        if not symbol_table:
+            return
+
+        addresses = [address for address in callsites if address is not None]
+
+        for address, sym in zip(addresses, symbol_table.symbolize_many(addresses)):
+            if sym is not None:
+                callsites[address]["symbol"] = sym.format(address - sym.address)
+
+    def snapshot(self):
+        """The current counters as a JSON serializable dict"""
+        # copies, the emulation thread keeps counting
+        lines = [(key, list(counts)) for key, counts in list(self._lines.items())]
+        peripherals = [
+            (name, list(counts)) for name, counts in list(self._peripherals.items())
+        ]
+
+        tasks = {}
+        callsites = {}
+
+        for (task_name, address), (emitted, omitted) in lines:
+            task = tasks.setdefault(task_name, {"emitted": 0, "omitted": 0})
+            task["emitted"] += emitted
+            task["omitted"] += omitted
+
+            callsite = callsites.get(address)
+
+            if callsite is None:
+                callsite = callsites[address] = {
+                    "address": address,
+                    "symbol": None,
+                    "emitted": 0,
+                    "omitted": 0,
+                    "tasks": [],
+                }
+
+            callsite["emitted"] += emitted
+            callsite["omitted"] += omitted
+            callsite["tasks"].append(task_name)
+
+        self._symbolize(callsites)
+
+        def total(counts):
+            return counts["emitted"] + counts["omitted"]
+
+        try:
+            time_running = self._machine.time_running()
+        except TypeError:
+            # not started yet
+            time_running = 0.0
+
+        return {
+            "time": time_running,
+            "emitted": sum([counts[0] for _, counts in lines]),
+            "omitted": sum([counts[1] for _, counts in lines]),
+            "tasks": dict(sorted(tasks.items(), key=lambda x: -total(x[1]))),
+            "callsites": sorted(callsites.values(), key=lambda x: -total(x)),
+            "peripherals": {
+                name: {"reads": reads, "writes": writes}
+                for name, (reads, writes) in sorted(
+                    peripherals, key=lambda x: -sum(x[1])
+                )
+            },
+        }
+
+    def dump(self, path):
+        """Write snapshot() to path as JSON. The file is replaced atomically"""
+        path = str(path)
+        tmp_path = path + ".tmp"
+
+        with open(tmp_path, "w") as fp:
+            json.dump(self.snapshot(), fp, indent=2)
+
+        os.replace(tmp_path, path)
+
+    def start_dump(self, path, interval):
+        """Dump the counters to path every interval seconds until stop_dump()"""
+        self.stop_dump()
+
+        self._dump_stop.clear()
+        self._dump_thread = threading.Thread(
+            target=self._dump_loop,
+            args=(path, interval),
+            name="FirmWireLogStats",
+            daemon=True,
+        )
+        self._dump_thread.start()
+
+    def stop_dump(self):
+        if self._dump_thread is None:
+            return
+
+        self._dump_stop.set()
+        self._dump_thread.join()
+        self._dump_thread = None
+
+    def _dump_loop(self, path, interval):
+        while True:
+            stopped = self._dump_stop.wait(interval)
+
+            try:
+                self.dump(path)
+            except (OSError, RuntimeError) as e:
+                log.warning("Failed to write log statistics to %s: %s", path, e)
+
+            if stopped:
+                break
+
+    def format_table(self, top=10):
+        """The top tasks, callsites and peripherals by volume as a text table"""
+        stats = self.snapshot()
+        rows = [
+            "Log statistics after %.2f seconds: %d lines emitted, %d omitted"
+            % (stats["time"], stats["emitted"], stats["omitted"])
+        ]
+
+        if stats["tasks"]:
+            rows += ["", "%-32s %12s %12s" % ("TASK", "EMITTED", "OMITTED")]
+
+            for name, counts in list(stats["tasks"].items())[:top]:
+                rows += [
+                    "%-32s %12d %12d" % (name, counts["emitted"], counts["omitted"])
+                ]
+
+        if stats["callsites"]:
+            rows += ["", "%-48s %12s %12s" % ("CALLSITE", "EMITTED", "OMITTED")]
+
+            for callsite in stats["callsites"][:top]:
+                if callsite["address"] is None:
+                    location = "(no address)"
+                elif callsite["symbol"] is not None:
+                    location = "%s (0x%x)" % (callsite["symbol"], callsite["address"])
+                else:
+                    location = "0x%x" % callsite["address"]
+
+                rows += [
+                    "%-48s %12d %12d"
+                    % (location, callsite["emitted"], callsite["omitted"])
+                ]
+
+        if stats["peripherals"]:
+            rows += ["", "%-32s %12s %12s" % ("PERIPHERAL", "READS", "WRITES")]
+
+            for name, counts in list(stats["peripherals"].items())[:top]:
+                rows += ["%-32s %12d %12d" % (name, counts["reads"], counts["writes"])]
+
+        return "\n".join(rows)
+
+    def print_table(self, top=10):
+        print(self.format_table(top=top))
+
+    def __repr__(self):
+        return "<LogStats %d lines, %d peripheral accesses>" % (
+            sum([sum(counts) for counts in list(self._lines.values())]),
+            sum([sum(counts) for counts in list(self._peripherals.values())]),
+        )
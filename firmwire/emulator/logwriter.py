@@ -0,0 +1,250 @@
+## Copyright (c) 2022, Team FirmWire
+## SPDX-License-Identifier: BSD-3-Clause
+import os
+import sys
+import atexit
+import logging
+import threading
+
+from collections import deque
+
+log = logging.getLogger(__name__)
+
+
+class StdoutSink:
+    """Writes lines to the current sys.stdout"""
+
+    def write_lines(self, lines):
+        out = sys.stdout
+        out.write("\n".join(lines) + "\n")
+        out.flush()
+
+    def close(self):
+        pass
+
+
+class FileSink:
+    def __init__(self, path):
+        self.path = str(path)
+        self._fp = open(self.path, "a")
+
+    def write_lines(self, lines):
+        self._fp.write("\n".join(lines) + "\n")
+        self._fp.flush()
+
+    def close(self):
+        self._fp.close()
+
+
+class RotatingFileSink(FileSink):
+    """
+    A FileSink that moves the file to path.1 (path.1 to path.2, ...) once it
+    grows beyond max_bytes. At most `backups` old files are kept
+    """
+
+    def __init__(self, path, max_bytes, backups=3):
+        if max_bytes <= 0:
+            raise ValueError("max_bytes must be positive")
+
+        super().__init__(path)
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self._size = self._fp.tell()
+
+    def write_lines(self, lines):
+        data = "\n".join(lines) + "\n"
+
+        if self._size > 0 and self._size + len(data) > self.max_bytes:
+            self._rotate()
+
+        self._fp.write(data)
+        self._fp.flush()
+        self._size += len(data)
+
+    def _rotate(self):
+        self._fp.close()
+
+        for i in range(self.backups - 1, 0, -1):
+            src = "%s.%d" % (self.path, i)
+
+            if os.path.exists(src):
+                os.replace(src, "%s.%d" % (self.path, i + 1))
+
+        if self.backups > 0:
+            os.replace(self.path, self.path + ".1")
+        else:
+            os.unlink(self.path)
+
+        self._fp = open(self.path, "a")
+        self._size = 0
+
+
+class SyncLogWriter:
+    """Writes every line immediately from the calling thread"""
+
+    def __init__(self, sink):
+        self.sink = sink
+        self.dropped = 0
+
+    def write(self, line):
+        self.sink.write_lines([line])
+
+    def flush(self, timeout=None):
+        return True
+
+    def close(self, timeout=None):
+        self.sink.close()
+
+
+class AsyncLogWriter:
+    """
+    Moves lines into a bounded in-memory ring, which a background thread drains
+    into the sink with batched writes
+
+    When the ring is full, the "block" policy waits for the writer thread and
+    the "drop" policy discards the line and counts it in `dropped`. A marker is
+    written in place of dropped lines, so the output stays in order. The ring is
+    drained at exit. A forked child starts over with an empty ring and its own
+    thread.
+    """
+
+    POLICIES = ["block", "drop"]
+
+    def __init__(self, sink, capacity=0x10000, policy="block"):
+        if capacity <= 0:
+            raise ValueError("capacity must be positive")
+
+        if policy not in self.POLICIES:
+            raise ValueError(
+                "Unknown policy %s (expected one of %s)" % (policy, self.POLICIES)
+            )
+
+        self.sink = sink
+        self.capacity = capacity
+        self.policy = policy
+        self.dropped = 0
+
+        self._closed = False
+        self._start()
+        atexit.register(self.close)
+
+    def _start(self):
+        self._pid = os.getpid()
+        self._ring = deque()
+        self._cond = threading.Condition()
+        self._busy = False
+        # dropped lines not yet reported in the output
+        self._unreported = 0
+        self._thread = None
+
+    def _ensure_thread(self):
+        # threads do not survive a fork. the ring belongs to the parent
+        if self._pid != os.getpid():
+            self._start()
+
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target=self._drain, name="FirmWireLogWriter", daemon=True
+            )
+            self._thread.start()
+
+    def write(self, line):
+        if self._closed:
+            raise ValueError("Write to a closed log writer")
+
+        self._ensure_thread()
+
+        with self._cond:
+            while len(self._ring) >= self.capacity:
+                if self.policy == "drop":
+                    self.dropped += 1
+                    self._unreported += 1
+                    return
+
+                self._cond.wait()
+
+            if self._unreported:
+                self._ring.append("[%d log lines dropped]" % self._unreported)
+                self._unreported = 0
+
+            self._ring.append(line)
+            self._cond.notify_all()
+
+    def _drain(self):
+        while True:
+            with self._cond:
+                while not self._ring and not self._closed:
+                    self._cond.wait()
+
+                if not self._ring:
+                    return
+
+                batch = list(self._ring)
+                self._ring.clear()
+                self._busy = True
+                self._cond.notify_all()
+
+            try:
+                self.sink.write_lines(batch)
+            except Exception:
+                log.exception("Failed to write %d guest log lines", len(batch))
+
+            with self._cond:
+                self._busy = False
+                self._cond.notify_all()
+
+    def flush(self, timeout=None):
+        """Wait until all lines have been written. Returns False on timeout"""
+        if self._pid != os.getpid() or self._thread is None:
+            return True
+
+        with self._cond:
+            return self._cond.wait_for(
+                lambda: not self._ring and not self._busy, timeout=timeout
+            )
+
+    def close(self, timeout=None):
+        if self._closed:
+            return
+
+        if self._pid == os.getpid() and self._thread is not None:
+            with self._cond:
+                if self._unreported:
+                    self._ring.append("[%d log lines dropped]" % self._unreported)
+                    self._unreported = 0
+
+                self._closed = True
+                self._cond.notify_all()
+
+            self._thread.join(timeout)
+
+        self._closed = True
+        atexit.unregister(self.close)
+        self.sink.close()
+
+
+def create_log_writer(
+    path=None, max_size=0, backups=3, capacity=0x10000, policy="block", sync=None
+):
+    """
+    Build a writer for stdout (no path), a file or a rotating file (max_size in bytes)
+
+    By default (sync=None) stdout is written synchronously, so that guest lines
+    stay in order with other log output on the terminal, and files from a
+    background thread. With sync=False stdout is written from the background
+    thread as well, at the cost of that ordering.
+    """
+    if path is None:
+        sink = StdoutSink()
+    elif max_size:
+        sink = RotatingFileSink(path, max_size, backups=backups)
+    else:
+        sink = FileSink(path)
+
+    if sync is None:
+        sync = path is None
+
+    if sync:
+        return SyncLogWriter(sink)
+
+    return AsyncLogWriter(sink, capacity=capacity, policy=policy)
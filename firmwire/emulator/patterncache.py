@@ -0,0 +1,126 @@
+## Copyright (c) 2022, Team FirmWire
+## SPDX-License-Identifier: BSD-3-Clause
+import os
+import sys
+import json
+import fcntl
+import hashlib
+import logging
+import tempfile
+
+log = logging.getLogger(__name__)
+
+
+def default_cache_path():
+    """Machine-wide cache location. FIRMWIRE_PATTERNDB_CACHE takes precedence"""
+    path = os.environ.get("FIRMWIRE_PATTERNDB_CACHE")
+
+    if path:
+        return path
+
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return os.path.join(base, "firmwire", "patterndb")
+
+
+def section_digest(data, offset):
+    """Content address of a scanned section at its load address"""
+    h = hashlib.sha256()
+    # _stable_hasher builds on hash(), which may change between interpreters
+    h.update(sys.implementation.cache_tag.encode())
+    h.update(b"%08x" % offset)
+    h.update(data)
+    return h.hexdigest()
+
+
+class SharedPatternCache:
+    """
+    Resolved pattern addresses shared by every workspace on this machine
+
+    Each section digest has its own JSON file mapping PatternDB cache keys to
+    addresses. Writers merge under a lock and atomically replace the file, so
+    readers never need to lock. Files are evicted least recently used first
+    once the directory grows beyond `max_size` bytes.
+
+    Cache keys hash the pattern entry and the code of its own lookup
+    functions, not the helpers they call. After changing such helpers, remove
+    the cache directory (or the files of the affected digests).
+    """
+
+    def __init__(self, path, max_size):
+        self.path = str(path)
+        self.max_size = max_size
+
+    def _entry_path(self, digest):
+        return os.path.join(self.path, digest + ".json")
+
+    def load(self, digest):
+        path = self._entry_path(digest)
+
+        try:
+            with open(path) as fp:
+                entries = json.load(fp)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            log.warning("Ignoring unreadable pattern cache %s: %s", path, e)
+            return {}
+
+        # mark as recently used
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+        return entries
+
+    def store(self, digest, entries):
+        if len(entries) == 0:
+            return
+
+        try:
+            os.makedirs(self.path, exist_ok=True)
+
+            with open(os.path.join(self.path, ".lock"), "a") as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+
+                merged = self.load(digest)
+                merged.update(entries)
+                self._write(self._entry_path(digest), merged)
+                self._evict(keep=digest + ".json")
+        except OSError as e:
+            log.warning("Unable to update the shared pattern cache: %s", e)
+
+    def _write(self, path, entries):
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+
+        try:
+            with os.fdopen(fd, "w") as fp:
+                json.dump(entries, fp)
+
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def _evict(self, keep):
+        files = []
+        total = 0
+
+        for name in os.listdir(self.path):
+            if not name.endswith(".json"):
+                continue
+
+            st = os.stat(os.path.join(self.path, name))
+            files += [(st.st_mtime, st.st_size, name)]
+            total += st.st_size
+
+        for mtime, size, name in sorted(files):
+            if total <= self.max_size:
+                break
+
+            if name == keep:
+                continue
+
+            os.unlink(os.path.join(self.path, name))
+            total -= size
+            log.debug("Evicted %s from the shared pattern cache", name)
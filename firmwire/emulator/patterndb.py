@@ -1,13 +1,51 @@
 ## Copyright (c) 2022, Team FirmWire
 ## SPDX-License-Identifier: BSD-3-Clause
+import os
 import logging
+import logging.handlers
+import multiprocessing
 import time
 import json
+from functools import partial
+from bisect import bisect_left
 from collections import OrderedDict
-from firmwire.util.BinaryPattern import BinaryPattern
+from firmwire.util.BinaryPattern import BinaryPattern, BinaryPatternSet
+from firmwire.emulator.patterncache import (
+    SharedPatternCache,
+    default_cache_path,
+    section_digest,
+)
 
 log = logging.getLogger(__name__)
 
+# Loader parameters understood by PatternDB. Merged into each loader's LOADER_ARGS
+PATTERNDB_LOADER_ARGS = {
+    "patterndb_jobs": {
+        "type": int,
+        "default": 1,
+        "help": "Number of processes used to resolve symbol patterns (0 for all CPUs)",
+    },
+    "patterndb_cache": {
+        "type": str,
+        "help": "Directory of the pattern cache shared across workspaces (default %s). "
+        "Delete it after changing lookup or post_lookup helpers, their results are cached by pattern entry only"
+        % default_cache_path(),
+    },
+    "patterndb_cache_size": {
+        "type": int,
+        "default": 0,
+        "help": "Size limit of the shared pattern cache in MiB (default 0, disabled)",
+    },
+    "patterndb_lazy": {
+        "type": int,
+        "default": 0,
+        "help": "Set to 1 to resolve optional patterns on their first lookup instead of at load time",
+    },
+}
+
+# Smallest slice of the image handed to a single worker
+PARALLEL_MIN_CHUNK = 0x100000
+
 
 def _stable_hasher(obj):
     if isinstance(obj, tuple):
@@ -93,13 +131,39 @@ class PatternDBEntry:
 
 
 class PatternDB:
-    def __init__(self, loader):
+    def __init__(self, loader, jobs=1, cache_path=None, cache_size=0, lazy=False):
         self.patterns = OrderedDict()
         self.loader = loader
+        self.jobs = jobs if jobs > 0 else os.cpu_count()
+        self.lazy = lazy
         self._pattern_cache_path = self.loader.workspace.path("/patterndb.cache")
 
         self._pattern_cache = {}
         self._load_pattern_cache()
+        # what the last find_patterns wrote out. Deferred results are added later
+        self._saved_cache = {}
+        # section offset -> [data, names of unresolved deferred patterns]
+        self._deferred_sections = {}
+
+        self._shared_cache = None
+
+        if cache_size > 0:
+            self._shared_cache = SharedPatternCache(
+                cache_path or default_cache_path(), cache_size * 1024 * 1024
+            )
+
+    @classmethod
+    def from_loader(cls, loader):
+        """Create a PatternDB configured by the PATTERNDB_LOADER_ARGS of a loader"""
+        args = loader.loader_args
+
+        return cls(
+            loader,
+            jobs=args["patterndb_jobs"],
+            cache_path=args["patterndb_cache"],
+            cache_size=args["patterndb_cache_size"],
+            lazy=bool(args["patterndb_lazy"]),
+        )
 
     def add_pattern(self, pattern):
         assert isinstance(pattern, PatternDBEntry)
@@ -130,23 +194,94 @@ class PatternDB:
         start_time = time.time()
 
         new_cache = {}
+        # the shared cache also remembers misses (None)
+        new_shared_cache = {}
+        cache_keys = OrderedDict()
+
+        for name, entry in self.patterns.items():
+            cache_keys[name] = "%s_%s" % (name, hash(entry))
+
+        # results from the shared cache are tied to these exact section bytes
+        known = dict(self._pattern_cache)
+        digest = None
+
+        if self._shared_cache is not None:
+            digest = section_digest(data, offset)
+
+            for cache_key, address in self._shared_cache.load(digest).items():
+                known[cache_key] = address
+
+        for name, cache_key in cache_keys.items():
+            # a SoC mismatch is not a property of the section
+            if known.get(cache_key, 0) is None and not self._soc_matches(
+                self.patterns[name]
+            ):
+                del known[cache_key]
+
+        uncached = [
+            name for name, cache_key in cache_keys.items() if cache_key not in known
+        ]
+        deferred = set()
+
+        if self.lazy:
+            deferred = set(
+                [name for name in uncached if self._can_defer(self.patterns[name])]
+            )
+            uncached = [name for name in uncached if name not in deferred]
+
+            if len(deferred):
+                log.info("Deferring %d optional patterns until first use", len(deferred))
+                # the section is only kept until its deferred patterns are resolved
+                self._deferred_sections[offset] = [data, set(deferred)]
+
+        if self.jobs > 1:
+            candidates, resolved = self._resolve_parallel(data, offset, uncached)
+        else:
+            candidates, resolved = self._scan_patterns(data, uncached), {}
 
         for name, entry in self.patterns.items():
-            cache_key = "%s_%s" % (name, hash(entry))
+            cache_key = cache_keys[name]
+
+            if name in deferred:
+                self.loader.symbol_table.add_deferred(
+                    name,
+                    partial(self._resolve_deferred, offset, name, cache_key, digest),
+                )
+                continue
+
+            if cache_key in known:
+                address = known[cache_key]
+
+                if address is None:
+                    new_shared_cache[cache_key] = None
+                    log.warning(
+                        "Unable to resolve dynamic symbol %s. Functionality may be affected [CACHED]",
+                        name,
+                    )
+                    continue
 
-            if cache_key in self._pattern_cache:
-                address = self._pattern_cache[cache_key]
                 sym = self.loader.symbol_table.add(name, address)
                 log.info("Found symbol %s -> %08x [CACHED]", name, address)
             else:
-                address = self._find_pattern(data, offset, name, entry)
+                address = self._find_pattern(
+                    data,
+                    offset,
+                    name,
+                    entry,
+                    candidates.get(name),
+                    resolved.get(name),
+                )
 
                 if address is None:
+                    if self._soc_matches(entry):
+                        new_shared_cache[cache_key] = None
+
                     continue
 
                 sym = self.loader.symbol_table.add(name, address)
 
             new_cache[cache_key] = address
+            new_shared_cache[cache_key] = address
 
             # post_lookup handlers can side-effect state. they can never be safely cached
             if "post_lookup" in entry:
@@ -158,72 +293,215 @@ class PatternDB:
         log.info("Dynamic symbol resolution took %.2f seconds", total_time)
 
         self._save_pattern_cache(new_cache)
+        self._saved_cache = new_cache
 
-    def _find_pattern(self, data, offset, name, entry):
-        required = entry.get("required")
-        addr = None
+        if self._shared_cache is not None:
+            self._shared_cache.store(digest, new_shared_cache)
 
+    def _can_defer(self, entry):
+        # post_lookup handlers have side effects that are expected at load time
+        return (
+            not entry.get("required")
+            and "post_lookup" not in entry
+            and self._soc_matches(entry)
+        )
+
+    def _resolve_deferred(self, offset, name, cache_key, digest):
+        data, pending = self._deferred_sections[offset]
+        address = self._find_pattern(data, offset, name, self.patterns[name])
+
+        pending.discard(name)
+
+        if len(pending) == 0:
+            del self._deferred_sections[offset]
+
+        if address is not None:
+            self._saved_cache[cache_key] = address
+            self._save_pattern_cache(self._saved_cache)
+
+        if self._shared_cache is not None:
+            self._shared_cache.store(digest, {cache_key: address})
+
+        return address
+
+    def _soc_matches(self, entry):
         if "soc_match" in entry:
-            if self.loader.modem_soc.name not in entry["soc_match"]:
-                log.info("Skipping symbol %s for %s", name, self.loader.modem_soc.name)
-                return None
+            return self.loader.modem_soc.name in entry["soc_match"]
 
-        pat_time_start = time.time()
+        return True
 
-        if "lookup" in entry:
-            addr = entry["lookup"](data, offset)
-        elif "pattern" in entry:
-            if isinstance(entry["pattern"], str):
-                entry["pattern"] = [entry["pattern"]]
+    def _build_scan_set(self, names):
+        scan_set = BinaryPatternSet()
+        compiled = OrderedDict()
+
+        for name in names:
+            entry = self.patterns[name]
+
+            if "lookup" in entry or "pattern" not in entry or "within" in entry:
+                continue
+
+            if not self._soc_matches(entry):
+                continue
+
+            patterns = entry["pattern"]
+
+            if isinstance(patterns, str):
+                patterns = [patterns]
 
-            for pat in entry["pattern"]:
+            compiled[name] = []
+
+            for pat in patterns:
                 bp = BinaryPattern(name)
                 bp.from_hex(pat)
+                scan_set.add(bp)
+                compiled[name] += [bp]
 
-                loc = None
+        return scan_set, compiled
 
-                search_range = (0, len(data))
+    def _scan_patterns(self, data, names):
+        """
+        Find the candidate matches of all plain hex patterns in one pass
 
-                # XXX: only works for MTK. SymbolTable needs concept of a range/size
-                if "within" in entry:
-                    start = self.loader.symbols[entry["within"]]
-                    symsize = self.loader.symbol_sizes[entry["within"]]
+        Entries restricted by `within` only cover a small window and are
+        searched directly. Returns a dict of name -> [(bp, candidates), ...]
+        in the same order as the entry's (alternate) patterns.
+        """
+        scan_set, compiled = self._build_scan_set(names)
 
-                    base_addr = start - offset
-                    search_range = (base_addr, base_addr + symsize)
+        if len(scan_set) == 0:
+            return {}
 
-                # Ensure the pattern conforms to an alignment
-                if "align" in entry:
-                    pos = search_range[0]
+        scan_start = time.time()
+        found = scan_set.scan(data)
 
-                    for tryno in range(20):
-                        loc = bp.find(data, pos=pos, maxpos=search_range[1])
-                        if loc is None:
-                            break
+        log.info(
+            "Scanned for %d patterns in one pass [%.2fs]",
+            len(scan_set),
+            time.time() - scan_start,
+        )
 
-                        if (loc[0] & (entry["align"] - 1)) == 0:
-                            break
+        return {
+            name: [(bp, found[bp]) for bp in bps] for name, bps in compiled.items()
+        }
 
-                        # Reset and try again
-                        pos = loc[1]
-                        loc = None
-                else:
-                    loc = bp.find(data, pos=search_range[0], maxpos=search_range[1])
+    def _resolve_parallel(self, data, offset, names):
+        """
+        Do the expensive part of find_patterns in worker processes
 
-                # No match, try alternate pattern
-                if loc is None:
-                    continue
+        The image is split into chunks that are scanned for candidates and
+        `lookup` handlers as well as patterns without a literal anchor run
+        as separate work items. Workers are forked, so they share the image
+        pages read-only without copying or pickling it.
 
-                if "offset" in entry:
-                    addr = loc[0] + offset + entry["offset"]
-                elif "offset_end" in entry:
-                    addr = loc[1] + offset + entry["offset_end"]
+        Verification, logging, `within` entries and post_lookup handlers are
+        left to the caller, which processes entries in registration order.
+        Returns the same candidates as _scan_patterns and a dict of
+        name -> (log records, exception, address, seconds).
+        """
+        global _parallel_state
+
+        scan_set, compiled = self._build_scan_set(names)
+        work = []
+
+        for name in names:
+            entry = self.patterns[name]
+
+            if "within" in entry or not self._soc_matches(entry):
+                continue
+
+            if "lookup" in entry:
+                work += [("entry", name)]
+            elif name in compiled and any(bp.anchor is None for bp in compiled[name]):
+                work += [("entry", name)]
+
+        if len(scan_set):
+            chunk_size = max(
+                -(-len(data) // (self.jobs * 4)), PARALLEL_MIN_CHUNK
+            )
+
+            for pos in range(0, len(data), chunk_size):
+                work += [("scan", pos, min(pos + chunk_size, len(data)))]
+
+        if len(work) == 0:
+            return {}, {}
+
+        scan_start = time.time()
+
+        # forked workers pick this up instead of having it pickled per item
+        _parallel_state = (self, data, offset, scan_set)
+
+        try:
+            ctx = multiprocessing.get_context("fork")
+
+            with ctx.Pool(min(self.jobs, len(work))) as pool:
+                results = pool.map(_parallel_work, work, chunksize=1)
+        finally:
+            _parallel_state = None
+
+        found = {bp: [] for bp in scan_set.patterns}
+        resolved = {}
+
+        for item, result in zip(work, results):
+            if item[0] == "entry":
+                resolved[item[1]] = result
+                continue
+
+            for bp, candidates in zip(scan_set.patterns, result):
+                if candidates is None:
+                    found[bp] = None
                 else:
-                    addr = loc[0] + offset
+                    found[bp] += candidates
+
+        if len(scan_set):
+            log.info(
+                "Scanned for %d patterns in one pass [%.2fs]",
+                len(scan_set),
+                time.time() - scan_start,
+            )
+
+        scanned = {
+            name: [(bp, found[bp]) for bp in bps] for name, bps in compiled.items()
+        }
 
+        return scanned, resolved
+
+    def _match_candidates(self, bp, data, candidates, pos, maxpos, align=None):
+        """Equivalent to BinaryPattern.find, only checking the scanned candidates"""
+        bp.rejected = 0
+
+        for start in candidates[bisect_left(candidates, pos) :]:
+            if start >= maxpos:
                 break
 
-        pat_time_end = time.time()
+            if align is not None and (start + bp.offset) % align:
+                bp.rejected += 1
+                continue
+
+            loc = bp.match_at(data, start, maxpos)
+
+            if loc is not None:
+                return loc
+
+        return None
+
+    def _find_pattern(self, data, offset, name, entry, scanned=None, resolved=None):
+        required = entry.get("required")
+
+        if not self._soc_matches(entry):
+            log.info("Skipping symbol %s for %s", name, self.loader.modem_soc.name)
+            return None
+
+        if resolved is None:
+            addr, pat_time = self._search_entry(data, offset, name, entry, scanned)
+        else:
+            records, error, addr, pat_time = resolved
+
+            # replay what the worker logged as if it ran here
+            for record in records:
+                logging.getLogger(record.name).handle(record)
+
+            if error is not None:
+                raise error
 
         if required and addr is None:
             log.warning("Unable to resolve required dynamic symbol %s", name)
@@ -235,7 +513,6 @@ class PatternDB:
             )
             return None
 
-        pat_time = pat_time_end - pat_time_start
         log.info("Found symbol %s -> %08x [%.2fs]", name, addr, pat_time)
 
         PAT_TIME_WARN = 5
@@ -247,3 +524,111 @@ class PatternDB:
             )
 
         return addr
+
+    def _search_entry(self, data, offset, name, entry, scanned=None):
+        """Resolve an entry without side effects. Returns (address, seconds)"""
+        addr = None
+        pat_time_start = time.time()
+
+        if "lookup" in entry:
+            addr = entry["lookup"](data, offset)
+        elif "pattern" in entry:
+            patterns = entry["pattern"]
+
+            if isinstance(patterns, str):
+                patterns = [patterns]
+
+            for i, pat in enumerate(patterns):
+                if scanned is not None:
+                    bp, candidates = scanned[i]
+                else:
+                    bp = BinaryPattern(name)
+                    bp.from_hex(pat)
+                    candidates = None
+
+                loc = None
+
+                search_range = (0, len(data))
+
+                if "within" in entry:
+                    within = self.loader.symbol_table.lookup(entry["within"])
+
+                    if within is None or within.size == 0:
+                        raise ValueError(
+                            "Pattern %s must be within %s, which has no known size"
+                            % (name, entry["within"])
+                        )
+
+                    base_addr = within.address - offset
+                    search_range = (base_addr, base_addr + within.size)
+
+                # Prefer the candidates from the single pass scan
+                if candidates is not None:
+                    loc = self._match_candidates(
+                        bp,
+                        data,
+                        candidates,
+                        search_range[0],
+                        search_range[1],
+                        align=entry.get("align"),
+                    )
+                else:
+                    loc = bp.find(
+                        data,
+                        pos=search_range[0],
+                        maxpos=search_range[1],
+                        align=entry.get("align"),
+                    )
+
+                if bp.rejected:
+                    log.debug(
+                        "%s: skipped %d unaligned candidates", name, bp.rejected
+                    )
+
+                # No match, try alternate pattern
+                if loc is None:
+                    continue
+
+                if "offset" in entry:
+                    addr = loc[0] + offset + entry["offset"]
+                elif "offset_end" in entry:
+                    addr = loc[1] + offset + entry["offset_end"]
+                else:
+                    addr = loc[0] + offset
+
+                break
+
+        return addr, time.time() - pat_time_start
+
+
+class _LogCapture(logging.handlers.QueueHandler):
+    def __init__(self):
+        super().__init__([])
+
+    def enqueue(self, record):
+        self.queue.append(record)
+
+
+_parallel_state = None
+
+
+def _parallel_work(item):
+    db, data, offset, scan_set = _parallel_state
+
+    if item[0] == "scan":
+        found = scan_set.scan(data, item[1], item[2], chunked=True)
+        return [found[bp] for bp in scan_set.patterns]
+
+    name = item[1]
+    capture = _LogCapture()
+    root = logging.getLogger()
+    handlers = root.handlers
+    root.handlers = [capture]
+
+    try:
+        addr, pat_time = db._search_entry(data, offset, name, db.patterns[name])
+        return (capture.queue, None, addr, pat_time)
+    except Exception as e:
+        return (capture.queue, e, None, 0)
+    finally:
+        root.handlers = handlers
@@ -1,6 +1,8 @@
 ## Copyright (c) 2022, Team FirmWire
 ## SPDX-License-Identifier: BSD-3-Clause
+import io
 import os
+import time
 import logging
 import json
 import re
@@ -10,12 +12,23 @@ import shlex
 
 from subprocess import run
 from datetime import datetime
+from collections import OrderedDict
+
+from .snapstate import (
+    SnapshotBlobStore,
+    MemorySnapshotBlobStore,
+    dump_snapshot_state,
+    load_snapshot_state,
+    scan_snapshot_state,
+)
 
 log = logging.getLogger(__name__)
 
 SNAPSHOT_RE = re.compile(r"[-a-zA-Z0-9_]+")
 
-SNAPSHOT_VERSION = 2
+SNAPSHOT_VERSION = 3
+# versions which can still be restored. v3 moved large buffers to blobs
+SNAPSHOT_COMPATIBLE_VERSIONS = [2, 3]
 
 # if the metadata or fields saved change, bump the version
 SNAPSHOT_METADATA = {
@@ -30,6 +43,9 @@ class QemuSnapshotManager(object):
     def __init__(self, snapshot_store):
         self.snapshot_store = snapshot_store
         self.snapshot_qcow_path = os.path.join(self.snapshot_store, "snapshots.qcow2")
+        self.blob_store = SnapshotBlobStore(
+            os.path.join(self.snapshot_store, "snapshot_blobs")
+        )
         self._clear_cache()
 
     def check(self, create_if_missing=True):
@@ -144,9 +160,16 @@ class QemuSnapshotManager(object):
 
         try:
             with open(snapshot_info_path, "wb") as fp:
-                pickle.dump(snapshot_info, fp)
-        except (pickle.PicklingError, IOError, TypeError, AttributeError) as e:
+                dump_snapshot_state(snapshot_info, fp, self.blob_store)
+        except (
+            pickle.PicklingError,
+            IOError,
+            TypeError,
+            AttributeError,
+            RuntimeError,
+        ) as e:
             log.error("Snapshot failed to save snapinfo: %s", e)
+            self._remove_snapinfo(snapshot_info_path)
             return False
 
         log.info("Snapshotting QEMU state...")
@@ -155,13 +178,45 @@ class QemuSnapshotManager(object):
         )
 
         if result != "":
-            os.unlink(snapshot_info_path)
+            self._remove_snapinfo(snapshot_info_path)
             log.error("Snapshot failed: " + result)
             return False
         else:
+            # blobs only used by a replaced snapshot of the same name
+            self.prune_blobs()
             log.info("Snapshot completed!")
             return True
 
+    def _remove_snapinfo(self, snapshot_info_path):
+        try:
+            os.unlink(snapshot_info_path)
+        except FileNotFoundError:
+            pass
+
+        self.prune_blobs()
+
+    def prune_blobs(self):
+        """Delete the blobs no snapinfo in the snapshot store references"""
+        digests = set()
+
+        for name in os.listdir(self.snapshot_store):
+            if not name.endswith(".snapinfo"):
+                continue
+
+            path = os.path.join(self.snapshot_store, name)
+
+            try:
+                with open(path, "rb") as fp:
+                    digests |= scan_snapshot_state(fp)
+            except (IOError, ValueError) as e:
+                log.warning("Not pruning snapshot blobs, unable to scan %s: %s", path, e)
+                return
+
+        pruned = self.blob_store.prune(digests)
+
+        if pruned:
+            log.info("Pruned %d unused snapshot blobs", pruned)
+
     def restore(self, name, monitor):
         # we assume QEMU is already stopped
         if not SNAPSHOT_RE.match(name):
@@ -204,7 +259,7 @@ class QemuSnapshotManager(object):
 
         try:
             with open(snapshot_info_path, "rb") as fp:
-                snapshot_info = pickle.load(fp)
+                snapshot_info = load_snapshot_state(fp, self.blob_store)
         except IOError:
             # likely pre-versioned snapshot store
             try:
@@ -226,12 +281,17 @@ class QemuSnapshotManager(object):
             except IOError:
                 log.error("Snapshot %s is missing auxiliary file", name)
                 return None
-        except (pickle.PicklingError, TypeError, AttributeError) as e:
+        except (
+            pickle.PicklingError,
+            pickle.UnpicklingError,
+            TypeError,
+            AttributeError,
+        ) as e:
             log.error("Snapshot failed to load snapinfo: %s", e)
             return None
 
         if snapshot_info["version"] > 0:
-            if snapshot_info["version"] != SNAPSHOT_VERSION:
+            if snapshot_info["version"] not in SNAPSHOT_COMPATIBLE_VERSIONS:
                 log.error(
                     "Saved snapshot version mismatch (got v%d, current v%d). Retake snapshot!",
                     snapshot_info["version"],
@@ -272,7 +332,7 @@ class QemuSnapshotManager(object):
         )
 
     def _validate_metadata(self, metadata):
-        if SNAPSHOT_VERSION in [1, 2]:
+        if SNAPSHOT_VERSION in [1, 2, 3]:
             for k, v in metadata.items():
                 if k not in SNAPSHOT_METADATA:
                     raise ValueError("Snapshot metadata key %s not supported" % k)
@@ -306,3 +366,238 @@ class QemuSnapshotManager(object):
             return None
 
         return proc.stdout.decode()
+
+
+# guest RAM is compared in blocks and restored in pages
+RAM_SNAPSHOT_BLOCK_SIZE = 0x10000
+RAM_SNAPSHOT_PAGE_SIZE = 0x1000
+
+
+class RamSnapshot(object):
+    def __init__(self, name, ram, registers, state, digests, metadata):
+        self.name = name
+        # memory range address -> list of RAM_SNAPSHOT_BLOCK_SIZE blocks
+        self.ram = ram
+        self.registers = registers
+        # the pickled snapinfo, loaded again for each restore
+        self.state = state
+        self.digests = digests
+        self.metadata = metadata
+        self.date = time.time()
+        self.restore_count = 0
+        self.restore_time = 0.0
+
+
+class RamSnapshotPool(object):
+    """
+    Snapshots of guest RAM, CPU registers and peripherals kept in memory
+
+    A drop-in for QemuSnapshotManager for fast restore loops. Restores compare
+    guest RAM with the snapshot block by block and only write back the pages
+    which changed. QEMU device state (e.g. timers and the system registers)
+    is not part of these snapshots. The least recently used snapshot is
+    dropped once there are more than `size`.
+    """
+
+    def __init__(self, machine, size):
+        if size < 1:
+            raise ValueError("A snapshot pool needs room for at least one snapshot")
+
+        self.machine = machine
+        self.size = size
+        self.snapshots = OrderedDict()
+        self.blob_store = MemorySnapshotBlobStore()
+
+    def check(self, create_if_missing=True):
+        return True
+
+    def list(self):
+        return {
+            name: {"date-sec": int(snap.date), "restore-count": snap.restore_count}
+            for name, snap in self.snapshots.items()
+        }
+
+    def _ram_ranges(self):
+        for mem in sorted(self.machine.avatar.memory_ranges, key=lambda x: x.begin):
+            if not self._is_ram(mem.data):
+                continue
+
+            yield mem.begin, mem.end - mem.begin
+
+    @staticmethod
+    def _is_ram(mr):
+        """
+        Plain or file-backed RAM. QEMU devices (a qemu_name range like the GIC)
+        and peripherals are skipped, as reading their registers has side
+        effects and writing them back is not a restore.
+        """
+        return not (
+            getattr(mr, "qemu_name", None)
+            or hasattr(mr, "python_peripheral")
+            or mr.forwarded
+            or mr.is_special
+            or mr.is_symbolic
+        )
+
+    def _read_blocks(self, address, size):
+        panda = self.machine.panda
+        return [
+            panda.physical_memory_read(
+                address + offset, min(RAM_SNAPSHOT_BLOCK_SIZE, size - offset)
+            )
+            for offset in range(0, size, RAM_SNAPSHOT_BLOCK_SIZE)
+        ]
+
+    def take(self, name, monitor, peripherals, machine_state, metadata={}):
+        # we assume QEMU is already stopped
+        if not SNAPSHOT_RE.match(name):
+            raise ValueError("Snapshot name %s illegal" % name)
+
+        start = time.time()
+
+        snapshot_info = {
+            "version": SNAPSHOT_VERSION,
+            "metadata": metadata,
+            "peripherals": peripherals,
+            "machine_state": machine_state,
+        }
+
+        fp = io.BytesIO()
+
+        try:
+            digests = dump_snapshot_state(snapshot_info, fp, self.blob_store)
+        except (pickle.PicklingError, TypeError, AttributeError) as e:
+            log.error("Snapshot failed to save snapinfo: %s", e)
+            return False
+
+        # share the blocks which did not change since the last snapshot
+        if self.snapshots:
+            previous = self.snapshots[next(reversed(self.snapshots))]
+        else:
+            previous = None
+
+        ram = {}
+
+        for address, size in self._ram_ranges():
+            blocks = self._read_blocks(address, size)
+            old_blocks = previous.ram.get(address) if previous else None
+
+            if old_blocks is not None and len(old_blocks) == len(blocks):
+                for i, block in enumerate(blocks):
+                    if block == old_blocks[i]:
+                        blocks[i] = old_blocks[i]
+
+            ram[address] = blocks
+
+        registers = {}
+
+        for reg in self.machine.avatar.arch.registers:
+            registers[reg] = self.machine.qemu.read_register(reg)
+
+        self.snapshots.pop(name, None)
+        self.snapshots[name] = RamSnapshot(
+            name, ram, registers, fp.getvalue(), digests, metadata
+        )
+
+        while len(self.snapshots) > self.size:
+            evicted, _ = self.snapshots.popitem(last=False)
+            log.info("Snapshot pool is full, dropped snapshot %s", evicted)
+
+        self._drop_unused_blobs()
+
+        log.info(
+            "Took RAM snapshot %s in %.3f seconds (%d of %d in the pool)",
+            name,
+            time.time() - start,
+            len(self.snapshots),
+            self.size,
+        )
+
+        return True
+
+    def _drop_unused_blobs(self):
+        digests = set()
+
+        for snap in self.snapshots.values():
+            digests |= snap.digests
+
+        self.blob_store.retain(digests)
+
+    def restore(self, name, monitor):
+        # we assume QEMU is already stopped
+        snap = self.snapshots.get(name)
+
+        if snap is None:
+            log.error("Snapshot %s is not in the snapshot pool", name)
+            return None
+
+        start = time.time()
+
+        # leave the machine alone if the snapinfo is unusable
+        try:
+            snapshot_info = load_snapshot_state(io.BytesIO(snap.state), self.blob_store)
+        except (pickle.UnpicklingError, TypeError, AttributeError) as e:
+            log.error("Snapshot failed to load snapinfo: %s", e)
+            return None
+
+        panda = self.machine.panda
+        pages = 0
+
+        for address, blocks in snap.ram.items():
+            for i, block in enumerate(blocks):
+                block_address = address + i * RAM_SNAPSHOT_BLOCK_SIZE
+                current = panda.physical_memory_read(block_address, len(block))
+
+                if current == block:
+                    continue
+
+                for offset in range(0, len(block), RAM_SNAPSHOT_PAGE_SIZE):
+                    end = offset + RAM_SNAPSHOT_PAGE_SIZE
+
+                    if current[offset:end] != block[offset:end]:
+                        panda.physical_memory_write(
+                            block_address + offset, block[offset:end]
+                        )
+                        pages += 1
+
+        for reg, value in snap.registers.items():
+            self.machine.qemu.write_register(reg, value)
+
+        if pages:
+            # code may have changed behind QEMU's back
+            panda.flush_tb()
+
+        elapsed = time.time() - start
+        snap.restore_count += 1
+        snap.restore_time += elapsed
+        self.snapshots.move_to_end(name)
+
+        log.info(
+            "Restored RAM snapshot %s in %.1f ms (%d pages written)",
+            name,
+            elapsed * 1000,
+            pages,
+        )
+
+        snapshot_info["qemu"] = {"date-sec": int(snap.date)}
+
+        return snapshot_info
+
+    def print_info(self, name):
+        snap = self.snapshots.get(name)
+
+        if snap is None:
+            raise ValueError("Invalid snapshot %s" % name)
+
+        if "address" in snap.metadata:
+            log.info("Snapshot address: 0x%08x", snap.metadata["address"])
+            log.info("Snapshot reason: %s", snap.metadata["reason"])
+
+        log.info("Snapshot time: %s", datetime.fromtimestamp(snap.date))
+
+        if snap.restore_count:
+            log.info(
+                "Snapshot restored %d times, %.1f ms on average",
+                snap.restore_count,
+                snap.restore_time / snap.restore_count * 1000,
+            )
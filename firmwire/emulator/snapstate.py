@@ -0,0 +1,226 @@
+## Copyright (c) 2022, Team FirmWire
+## SPDX-License-Identifier: BSD-3-Clause
+import os
+import re
+import pickle
+import hashlib
+import pickletools
+import logging
+import tempfile
+
+import lz4.frame
+
+log = logging.getLogger(__name__)
+
+# smaller buffers stay in the pickle
+SNAPSHOT_BLOB_MIN_SIZE = 0x1000
+
+SNAPSHOT_BLOB_RE = re.compile(r"[0-9a-f]{64}")
+
+
+class SnapshotBlobStore:
+    """
+    LZ4 compressed buffers named by the SHA-256 of their content
+
+    Buffers which did not change between snapshots are stored once.
+    """
+
+    def __init__(self, path):
+        self.path = str(path)
+
+    def _blob_path(self, digest):
+        return os.path.join(self.path, digest + ".lz4")
+
+    def put(self, data):
+        """Store data if missing and return its digest"""
+        digest = hashlib.sha256(data).hexdigest()
+        path = self._blob_path(digest)
+
+        if os.path.exists(path):
+            return digest
+
+        os.makedirs(self.path, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+
+        try:
+            with os.fdopen(fd, "wb") as fp:
+                fp.write(lz4.frame.compress(data))
+
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+        return digest
+
+    def get(self, digest):
+        path = self._blob_path(digest)
+
+        try:
+            with open(path, "rb") as fp:
+                data = lz4.frame.decompress(fp.read())
+        except (OSError, RuntimeError) as e:
+            raise pickle.UnpicklingError("Unable to read snapshot blob %s: %s" % (path, e))
+
+        if hashlib.sha256(data).hexdigest() != digest:
+            raise pickle.UnpicklingError("Snapshot blob %s is corrupt" % path)
+
+        return data
+
+    def prune(self, digests):
+        """Delete all blobs except digests and return how many were deleted"""
+        try:
+            names = os.listdir(self.path)
+        except FileNotFoundError:
+            return 0
+
+        pruned = 0
+
+        for name in names:
+            digest, ext = os.path.splitext(name)
+
+            if ext != ".lz4" or digest in digests:
+                continue
+
+            try:
+                os.unlink(os.path.join(self.path, name))
+                pruned += 1
+            except FileNotFoundError:
+                pass
+
+        return pruned
+
+
+class MemorySnapshotBlobStore:
+    """A SnapshotBlobStore kept in memory, for snapshots which are never written"""
+
+    def __init__(self):
+        self.blobs = {}
+
+    def put(self, data):
+        digest = hashlib.sha256(data).hexdigest()
+        self.blobs.setdefault(digest, bytes(data))
+        return digest
+
+    def get(self, digest):
+        try:
+            return self.blobs[digest]
+        except KeyError:
+            raise pickle.UnpicklingError("Missing snapshot blob %s" % digest)
+
+    def retain(self, digests):
+        """Drop all blobs except digests"""
+        self.blobs = {d: self.blobs[d] for d in digests if d in self.blobs}
+
+
+def _byte_list(obj):
+    """The bytes of a list holding one int per byte or None"""
+    if len(obj) < SNAPSHOT_BLOB_MIN_SIZE:
+        return None
+
+    # bytes() would also take bools and other ints-alike
+    if set(map(type, obj)) != {int}:
+        return None
+
+    try:
+        return bytes(obj)
+    except ValueError:
+        return None
+
+
+class SnapshotStatePickler(pickle.Pickler):
+    """
+    Pickles snapshot state with large buffers moved to a SnapshotBlobStore
+
+    Lists of byte values (e.g. PassthroughPeripheral.mem, CircularFIFO.fifo),
+    bytes and bytearrays are replaced by references to blobs. Everything
+    else, like register values, is pickled as usual.
+    """
+
+    def __init__(self, fp, blob_store):
+        super().__init__(fp, protocol=pickle.HIGHEST_PROTOCOL)
+        self.blob_store = blob_store
+        # id -> (persistent id, obj). keeps shared buffers shared
+        self._blobs = {}
+        # the blobs referenced by the pickle
+        self.digests = set()
+
+    def persistent_id(self, obj):
+        kind = type(obj)
+
+        if kind is list:
+            data = _byte_list(obj)
+        elif kind is bytes or kind is bytearray:
+            data = obj if len(obj) >= SNAPSHOT_BLOB_MIN_SIZE else None
+        else:
+            return None
+
+        if data is None:
+            return None
+
+        blob = self._blobs.get(id(obj))
+
+        if blob is None:
+            pid = (kind.__name__, self.blob_store.put(data), len(self._blobs))
+            # hold obj so that its id is not reused while pickling
+            blob = self._blobs[id(obj)] = (pid, obj)
+            self.digests.add(pid[1])
+
+        return blob[0]
+
+
+class SnapshotStateUnpickler(pickle.Unpickler):
+    """Loads what SnapshotStatePickler wrote (and plain pickles)"""
+
+    def __init__(self, fp, blob_store):
+        super().__init__(fp)
+        self.blob_store = blob_store
+        self._blobs = {}
+
+    def persistent_load(self, pid):
+        kind, digest, idx = pid
+
+        if idx in self._blobs:
+            return self._blobs[idx]
+
+        data = self.blob_store.get(digest)
+
+        if kind == "list":
+            obj = list(data)
+        elif kind == "bytearray":
+            obj = bytearray(data)
+        elif kind == "bytes":
+            obj = data
+        else:
+            raise pickle.UnpicklingError("Unsupported snapshot blob type %s" % kind)
+
+        self._blobs[idx] = obj
+        return obj
+
+
+def dump_snapshot_state(state, fp, blob_store):
+    """Pickle state to fp and return the digests of the blobs it references"""
+    pickler = SnapshotStatePickler(fp, blob_store)
+    pickler.dump(state)
+    return pickler.digests
+
+
+def load_snapshot_state(fp, blob_store):
+    return SnapshotStateUnpickler(fp, blob_store).load()
+
+
+def scan_snapshot_state(fp):
+    """
+    The digests of the blobs a pickle may reference, without loading it
+
+    Every string which looks like a digest is taken, so the result may hold
+    more than the pickle uses, never less. Raises ValueError if the pickle
+    is truncated or corrupt.
+    """
+    digests = set()
+
+    for _, arg, _ in pickletools.genops(fp):
+        if isinstance(arg, str) and SNAPSHOT_BLOB_RE.fullmatch(arg):
+            digests.add(arg)
+
+    return digests
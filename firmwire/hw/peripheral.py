@@ -52,6 +52,9 @@ class FirmWirePeripheral(avatar2.AvatarPeripheral):
         self.machine = machine
 
     def log_read(self, value, size, offset_name):
+        if self.machine.log_stats.enabled:
+            self.machine.log_stats.count_peripheral(self.name, False)
+
         self.log.info(
             "%s: %0" + str(size * 2) + "x <- %s[%s]",
             self.format_address(self.pc),
@@ -61,6 +64,9 @@ class FirmWirePeripheral(avatar2.AvatarPeripheral):
         )
 
     def log_write(self, value, size, offset_name):
+        if self.machine.log_stats.enabled:
+            self.machine.log_stats.count_peripheral(self.name, True)
+
         self.log.info(
             "%s: %s[%s] <- %0" + str(size * 2) + "x",
             self.format_address(self.pc),
@@ -73,16 +79,11 @@ class FirmWirePeripheral(avatar2.AvatarPeripheral):
         if not self.machine.symbol_table:
             return "0x%08x" % addr
         else:
-            sym = self.machine.symbol_table.lookup(addr)
+            sym = self.machine.symbol_table.symbolize(addr)
             if sym is None:
                 return "0x%08x" % addr
 
-            offset = addr - sym.address
-
-            if abs(offset) > 0x1000:
-                return "0x%08x" % addr
-            else:
-                return sym.format(offset)
+            return sym.format(addr - sym.address)
 
     def cyclic_bit(self, pattern=1, cycle_len=33):
         """p2im inspired cyclic bit pattern to get past status bit checks"""
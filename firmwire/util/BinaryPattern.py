@@ -3,6 +3,11 @@
 import struct
 import re
 from binascii import hexlify
+from collections import OrderedDict
+
+# shorter literal runs (and runs of a single repeated byte, like padding) hit
+# too often on real images to be worth prefiltering with
+BINARY_PATTERN_MIN_ANCHOR = 4
 
 #
 # BinaryPattern by Grant Hernandez
@@ -12,6 +17,12 @@ class BinaryPattern(object):
         self.name = name
         self.pattern = None
         self.offset = offset
+        # (position, bytes) of the longest usable literal run at a fixed
+        # distance from the start of the pattern, see _usable_anchor. Used by
+        # BinaryPatternSet for prefiltering
+        self.anchor = None
+        # number of unaligned matches skipped by the last find/findall
+        self.rejected = 0
 
     def __repr__(self):
         return "<BinaryPattern '%s'>" % self.name
@@ -20,7 +31,15 @@ class BinaryPattern(object):
         re_pat = rb"" + hexlify(pat)
         self.from_hex(re_pat.decode())
 
-    def find(self, data, pos=0, maxpos=-1):
+    def find(self, data, pos=0, maxpos=-1, align=None):
+        """
+        Find the first match in data[pos:maxpos]
+
+        data can be any buffer (bytes, memoryview, mmap). It is searched in place.
+        With `align`, only matches starting (including the pattern offset) at a
+        multiple of `align` are considered. The number of unaligned matches that
+        were passed over is kept in `self.rejected`
+        """
         if self.pattern is None:
             raise ValueError("Pattern has not been compiled")
 
@@ -36,30 +55,96 @@ class BinaryPattern(object):
         elif pos >= maxpos:
             raise ValueError("pos must be less than maxpos")
 
-        match = self.pattern.search(data[pos:maxpos])
+        self.rejected = 0
+        match = self._search(data, pos, maxpos, align)
 
         if not match:
             return None
 
         span = match.span()
-        return (span[0] + self.offset + pos, span[1] + self.offset + pos)
+        return (span[0] + self.offset, span[1] + self.offset)
 
-    def findall(self, data, pos=0, maxpos=-1, maxresults=0):
-        found = []
+    def _search(self, data, pos, maxpos, align):
+        if align is None:
+            return self.pattern.search(data, pos, maxpos)
 
-        while True:
-            res = self.find(data, pos=pos, maxpos=maxpos)
+        if align <= 0:
+            raise ValueError("align must be positive")
+
+        while pos < maxpos:
+            match = self.pattern.search(data, pos, maxpos)
+
+            if not match:
+                return None
+
+            start = match.start()
+            misalignment = (start + self.offset) % align
+
+            if misalignment == 0:
+                return match
+
+            # resume at the next aligned start, which may be inside this match
+            self.rejected += 1
+            pos = start + align - misalignment
+
+        return None
+
+    def match_at(self, data, start, maxpos=-1):
+        """Try to match the pattern exactly at `start`"""
+        if self.pattern is None:
+            raise ValueError("Pattern has not been compiled")
+
+        if maxpos < 0:
+            maxpos = len(data)
 
-            if res is None:
+        match = self.pattern.match(data, start, maxpos)
+
+        if not match:
+            return None
+
+        span = match.span()
+        return (span[0] + self.offset, span[1] + self.offset)
+
+    def findall(self, data, pos=0, maxpos=-1, maxresults=0, align=None):
+        """Lazily iterate over the non-overlapping (aligned) matches in data[pos:maxpos]"""
+        if self.pattern is None:
+            raise ValueError("Pattern has not been compiled")
+
+        if maxpos < 0:
+            maxpos = len(data)
+
+        self.rejected = 0
+        found = 0
+
+        if align is None:
+            matches = self.pattern.finditer(data, pos, maxpos)
+        else:
+            matches = self._finditer_aligned(data, pos, maxpos, align)
+
+        for match in matches:
+            span = match.span()
+            yield (span[0] + self.offset, span[1] + self.offset)
+
+            found += 1
+
+            if maxresults and maxresults <= found:
                 break
 
-            pos = res[1]
-            found += [res]
+    def _finditer_aligned(self, data, pos, maxpos, align):
+        while pos < maxpos:
+            match = self._search(data, pos, maxpos, align)
 
-            if maxresults and maxresults <= len(found):
+            if not match:
                 break
 
-        return found
+            yield match
+
+            # step past empty matches like finditer does
+            pos = max(match.end(), match.start() + 1)
+
+    @staticmethod
+    def _usable_anchor(run):
+        return len(run) >= BINARY_PATTERN_MIN_ANCHOR and run.count(run[:1]) != len(run)
 
     def from_hex(self, hexpat):
         re_pat = rb""
@@ -68,6 +153,13 @@ class BinaryPattern(object):
         expect_next_wildcard = False
         expect_next_hex = False
 
+        # anchor tracking. Only valid while the pattern length is fixed
+        fixed_len = 0
+        run_start = 0
+        run = b""
+        anchor = None
+        variable = False
+
         while pos < len(hexpat):
             c = hexpat[pos : pos + 1]
 
@@ -89,10 +181,20 @@ class BinaryPattern(object):
                     # Match as little as possible
                     if c[0] == "+":
                         re_pat += rb"(.{1,100}?)"
+                        variable = True
                     elif c[0] == "*":
                         re_pat += rb"(.{0,100}?)"
+                        variable = True
                     else:
                         re_pat += rb"."
+                        fixed_len += 1
+
+                    if self._usable_anchor(run) and (
+                        anchor is None or len(run) > len(anchor[1])
+                    ):
+                        anchor = (run_start, run)
+
+                    run = b""
                 else:
                     expect_next_wildcard = True
 
@@ -100,6 +202,13 @@ class BinaryPattern(object):
                 if expect_next_hex:
                     expect_next_hex = False
                     re_pat += b"\\x%s" % hexpat[pos - 1 : pos + 1].encode()
+
+                    if not variable:
+                        if not run:
+                            run_start = fixed_len
+
+                        run += bytes([int(hexpat[pos - 1 : pos + 1], 16)])
+                        fixed_len += 1
                 else:
                     expect_next_hex = True
             else:
@@ -115,5 +224,123 @@ class BinaryPattern(object):
         if expect_next_hex:
             raise ValueError("Incomplete hex value at end of pattern")
 
+        if self._usable_anchor(run) and (anchor is None or len(run) > len(anchor[1])):
+            anchor = (run_start, run)
+
         # We're searching through binary data -- Newlines are included
         self.pattern = re.compile(re_pat, flags=re.DOTALL)
+        self.anchor = anchor
+
+
+class BinaryPatternSet(object):
+    """
+    Search for many BinaryPatterns with a single pass over the data
+
+    The literal anchors of all patterns are compiled into one alternation
+    which is used to walk the data once. Each hit is expanded to the
+    candidate start positions of the patterns sharing that anchor. Patterns
+    without a usable anchor (see BINARY_PATTERN_MIN_ANCHOR) are searched
+    individually.
+    """
+
+    def __init__(self):
+        self.patterns = []
+        self._anchors = OrderedDict()
+        self._by_first_byte = {}
+        self._unanchored = []
+        self._max_anchor_len = 0
+        self._matcher = None
+
+    def __len__(self):
+        return len(self.patterns)
+
+    def add(self, bp):
+        if bp.pattern is None:
+            raise ValueError("Pattern has not been compiled")
+
+        self.patterns += [bp]
+        self._matcher = None
+
+        if bp.anchor is None:
+            self._unanchored += [bp]
+            return
+
+        anchor_pos, anchor = bp.anchor
+
+        if anchor not in self._anchors:
+            self._anchors[anchor] = []
+            self._by_first_byte.setdefault(anchor[0], []).append(anchor)
+            self._max_anchor_len = max(self._max_anchor_len, len(anchor))
+
+        self._anchors[anchor] += [(anchor_pos, bp)]
+
+    def _compile(self):
+        if self._matcher is None and len(self._anchors):
+            self._matcher = re.compile(
+                b"|".join([re.escape(a) for a in self._anchors.keys()]),
+                flags=re.DOTALL,
+            )
+
+        return self._matcher
+
+    def scan(self, data, pos=0, maxpos=-1, chunked=False):
+        """
+        Walk the data once and return the candidate start offsets per pattern
+
+        Candidates are sorted and a superset of the positions where each
+        pattern can match. Use BinaryPattern.match_at to verify them.
+        Unanchored patterns are reported as None.
+
+        When chunked, anchors starting before maxpos may extend past it. The
+        results of adjacent [pos, maxpos) chunks can then be concatenated.
+        """
+        if maxpos < 0:
+            maxpos = len(data)
+
+        endpos = maxpos
+
+        if chunked:
+            endpos = min(maxpos + self._max_anchor_len - 1, len(data))
+
+        candidates = {bp: [] for bp in self.patterns}
+
+        for bp in self._unanchored:
+            candidates[bp] = None
+
+        matcher = self._compile()
+
+        if matcher is None:
+            return candidates
+
+        search = matcher.search
+        by_first_byte = self._by_first_byte
+        anchors = self._anchors
+
+        while True:
+            match = search(data, pos, endpos)
+
+            if match is None:
+                break
+
+            hit = match.start()
+
+            if hit >= maxpos:
+                break
+
+            # the alternation only reports one anchor per position.
+            # any other anchor starting here shares its first byte
+            for anchor in by_first_byte[data[hit]]:
+                anchor_end = hit + len(anchor)
+
+                if anchor_end > endpos or data[hit:anchor_end] != anchor:
+                    continue
+
+                for anchor_pos, bp in anchors[anchor]:
+                    start = hit - anchor_pos
+
+                    if start >= 0:
+                        candidates[bp] += [start]
+
+            pos = hit + 1
+
+        return candidates
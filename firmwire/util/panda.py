@@ -6,3 +6,47 @@ def read_cstring_panda(panda, addr, max_length=0x200):
 
     s = panda.physical_memory_read(addr, max_length)
     return s[: s.find(b"\x00")].decode("ascii", "ignore")
+
+
+def read_cstrings_panda(panda, addrs, max_length=0x200, max_span=0x10000):
+    """
+    read_cstring_panda for many addresses, returned as a dict
+
+    Addresses whose max_length windows overlap are read with a single PANDA
+    call, up to max_span bytes at once.
+    """
+    strings = {}
+
+    if 0 in addrs:
+        strings[0] = "NULL"
+
+    addrs = sorted(set(addrs) - set([0]))
+    i = 0
+
+    while i < len(addrs):
+        start = addrs[i]
+        j = i + 1
+
+        while (
+            j < len(addrs)
+            and addrs[j] <= addrs[j - 1] + max_length
+            and addrs[j] + max_length - start <= max_span
+        ):
+            j += 1
+
+        try:
+            data = panda.physical_memory_read(start, addrs[j - 1] + max_length - start)
+        except ValueError:
+            # part of the span is unmapped, fail (or not) like single reads do
+            data = None
+
+        for addr in addrs[i:j]:
+            if data is None:
+                strings[addr] = read_cstring_panda(panda, addr, max_length)
+            else:
+                s = data[addr - start : addr - start + max_length]
+                strings[addr] = s[: s.find(b"\x00")].decode("ascii", "ignore")
+
+        i = j
+
+    return strings
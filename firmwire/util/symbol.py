@@ -1,11 +1,22 @@
 ## Copyright (c) 2022, Team FirmWire
 ## SPDX-License-Identifier: BSD-3-Clause
+import os
+import sys
 import csv
 import json
+import mmap
+import logging
+import bisect
+import struct
+import tempfile
+import threading
 import lz4.frame
 
+from array import array
 from enum import IntEnum
 
+log = logging.getLogger(__name__)
+
 
 class SymbolType(IntEnum):
     UNKNOWN = 0
@@ -39,19 +50,27 @@ class Symbol(object):
         "address",
         "name",
         "symbol_ty",
+        "size",
     )
 
-    def __init__(self, name, address, symbol_ty):
+    def __init__(self, name, address, symbol_ty, size=0):
         if not isinstance(name, str):
             raise TypeError("Invalid constructor type")
         if not isinstance(address, int):
             raise TypeError("Invalid constructor type")
         if not isinstance(symbol_ty, SymbolType):
             raise TypeError("Invalid constructor type")
+        if not isinstance(size, int):
+            raise TypeError("Invalid constructor type")
 
         self.address = address
         self.name = name
         self.symbol_ty = symbol_ty
+        # size in bytes. 0 if unknown
+        self.size = size
+
+    def contains(self, address):
+        return self.address <= address < self.address + self.size
 
     def format(self, offset=0):
         if offset > 0:
@@ -62,55 +81,374 @@ class Symbol(object):
             return "%s" % (self.name)
 
     def __repr__(self):
+        if self.size:
+            return "<Symbol %s @ 0x%x, size=0x%x, ty=%s>" % (
+                self.name,
+                self.address,
+                self.size,
+                self.symbol_ty,
+            )
+
         return "<Symbol %s @ 0x%x, ty=%s>" % (self.name, self.address, self.symbol_ty)
 
 
+SYMBOL_FILE_MAGIC = b"FWSYMDB\x02"
+# magic, number of symbols, string table size
+SYMBOL_FILE_HEADER = struct.Struct("<8sII")
+
+
+def write_symbol_file(filename, symbols):
+    """
+    Write symbols in the binary format read by MappedSymbols
+
+    The file holds columns of addresses (u64), name offsets and lengths (u32),
+    sizes (u32), the symbol indices sorted by name (u32) and the symbol types
+    (u8), followed by a deduplicated UTF-8 string table. It is replaced
+    atomically.
+    """
+    symbols = sorted(symbols, key=lambda x: x.address)
+    strtab = bytearray()
+    string_offsets = {}
+    names = []
+    name_offs = array("I")
+    name_lens = array("I")
+
+    for sym in symbols:
+        name = sym.name.encode()
+
+        if name not in string_offsets:
+            string_offsets[name] = len(strtab)
+            strtab += name
+
+        names += [name]
+        name_offs.append(string_offsets[name])
+        name_lens.append(len(name))
+
+    by_name = array("I", sorted(range(len(symbols)), key=lambda i: (names[i], i)))
+    addrs = array("Q", [sym.address for sym in symbols])
+    sizes = array("I", [sym.size for sym in symbols])
+    types = array("B", [int(sym.symbol_ty) for sym in symbols])
+
+    for column in [addrs, name_offs, name_lens, sizes, by_name]:
+        if column.itemsize != 1 and sys.byteorder != "little":
+            column.byteswap()
+
+    directory = os.path.dirname(os.path.abspath(filename))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+
+    try:
+        with os.fdopen(fd, "wb") as fp:
+            fp.write(SYMBOL_FILE_HEADER.pack(SYMBOL_FILE_MAGIC, len(symbols), len(strtab)))
+
+            for column in [addrs, name_offs, name_lens, sizes, by_name, types]:
+                fp.write(column.tobytes())
+
+            fp.write(strtab)
+
+        os.replace(tmp_path, filename)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+class MappedSymbols(object):
+    """
+    Read-only symbols memory-mapped from a file written by write_symbol_file
+
+    The mapping is shared through the page cache by every process loading the
+    same file. Symbol objects are only created for the entries that are looked
+    up and are kept, so the same entry is always the same object. Removed
+    entries are hidden, not deleted.
+    """
+
+    def __init__(self, filename):
+        with open(filename, "rb") as fp:
+            self._map = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if len(self._map) < SYMBOL_FILE_HEADER.size:
+            raise ValueError("Symbol file %s is truncated" % filename)
+
+        magic, count, strtab_size = SYMBOL_FILE_HEADER.unpack_from(self._map)
+
+        if magic[:-1] != SYMBOL_FILE_MAGIC[:-1]:
+            raise ValueError("%s is not a symbol file" % filename)
+
+        if magic != SYMBOL_FILE_MAGIC:
+            raise ValueError("Symbol file %s has an unsupported version" % filename)
+
+        if sys.byteorder != "little":
+            raise ValueError("Symbol files can only be mapped on little endian hosts")
+
+        size = SYMBOL_FILE_HEADER.size + count * (8 + 4 * 4 + 1) + strtab_size
+
+        if len(self._map) != size:
+            raise ValueError("Symbol file %s is truncated" % filename)
+
+        view = memoryview(self._map)
+        pos = SYMBOL_FILE_HEADER.size
+
+        def column(fmt, itemsize):
+            nonlocal pos
+            col = view[pos : pos + count * itemsize].cast(fmt)
+            pos += count * itemsize
+            return col
+
+        self.addrs = column("Q", 8)
+        self._name_offs = column("I", 4)
+        self._name_lens = column("I", 4)
+        self.sizes = column("I", 4)
+        self._by_name = column("I", 4)
+        self._types = column("B", 1)
+        self._strtab = view[pos:]
+
+        self._count = count
+        self._removed = bytearray(count)
+        self._live = count
+        self._materialised = {}
+
+    def __len__(self):
+        return self._live
+
+    def _name_bytes(self, idx):
+        off = self._name_offs[idx]
+        return self._strtab[off : off + self._name_lens[idx]].tobytes()
+
+    def symbol(self, idx):
+        sym = self._materialised.get(idx)
+
+        if sym is None:
+            sym = Symbol(
+                self._name_bytes(idx).decode(),
+                self.addrs[idx],
+                SymbolType(self._types[idx]),
+                self.sizes[idx],
+            )
+            self._materialised[idx] = sym
+
+        return sym
+
+    def all_symbols(self):
+        return [self.symbol(i) for i in range(self._count) if not self._removed[i]]
+
+    def find_name(self, name):
+        """Indices of the live symbols called name, in address order"""
+        name = name.encode()
+        left, right = 0, self._count
+
+        while left < right:
+            mid = (left + right) // 2
+
+            if self._name_bytes(self._by_name[mid]) < name:
+                left = mid + 1
+            else:
+                right = mid
+
+        indices = []
+
+        while left < self._count:
+            idx = self._by_name[left]
+
+            if self._name_bytes(idx) != name:
+                break
+
+            if not self._removed[idx]:
+                indices += [idx]
+
+            left += 1
+
+        return indices
+
+    def remove(self, idx):
+        if not self._removed[idx]:
+            self._removed[idx] = 1
+            self._live -= 1
+
+    def closest(self, address):
+        """
+        Index of the first live symbol at address, else the last one below it.
+        Addresses before every symbol resolve to the first one (like SymbolTable)
+        """
+        if self._live == 0:
+            return None
+
+        idx = bisect.bisect_left(self.addrs, address)
+
+        while idx < self._count and self.addrs[idx] == address:
+            if not self._removed[idx]:
+                return idx
+
+            idx += 1
+
+        idx = bisect.bisect_left(self.addrs, address) - 1
+
+        while idx >= 0:
+            if not self._removed[idx]:
+                return idx
+
+            idx -= 1
+
+        idx = 0
+
+        while self._removed[idx]:
+            idx += 1
+
+        return idx
+
+
 class SymbolTable(object):
+    """
+    Symbols sorted by address with an index by name
+
+    Symbols are kept in blocks of at most 2*BLOCK_SIZE entries. Each block
+    has a compact array of its addresses next to the Symbol objects, so that
+    inserts and removes only shift a single block and address lookups are
+    two binary searches.
+
+    A binary symbol file can be mapped underneath with load_binary. Symbols
+    added afterwards are kept in the blocks and sort after mapped symbols
+    sharing their address.
+
+    Symbols with a size are also indexed as intervals to answer which symbol
+    contains an address. The index is (re)built on the first query after a
+    sized symbol changed.
+
+    Changes to the address index hold a lock, so that symbolize_many can be
+    called from other threads (e.g. the LogStats dump thread) while the
+    emulation thread adds or resolves symbols.
+    """
+
+    BLOCK_SIZE = 512
+
     def __init__(self):
-        self.symbols = []
+        # parallel lists of address arrays and Symbol lists
+        self._addrs = []
+        self._syms = []
+        # highest address of each block
+        self._maxes = []
+        self._len = 0
+        self._flat = None
+        # read-only MappedSymbols below the blocks
+        self._mapped = None
+        # disjoint [start, end) segments of the innermost sized symbols
+        self._iv_starts = None
+        self._iv_ends = None
+        self._iv_owners = None
         self.by_name = {}
+        # name -> callable returning an address (or None), run on first lookup
+        self._deferred = {}
+        self._lock = threading.RLock()
 
     def __len__(self):
-        return len(self.symbols)
+        if self._mapped is not None:
+            return self._len + len(self._mapped)
+
+        return self._len
+
+    @property
+    def symbols(self):
+        """All symbols in address order. This materialises all mapped symbols"""
+        if self._flat is None:
+            self._flat = [sym for block in self._syms for sym in block]
+
+            if self._mapped is not None:
+                self._flat = sorted(
+                    self._mapped.all_symbols() + self._flat, key=lambda x: x.address
+                )
+
+        return self._flat
+
+    def load_binary(self, filename):
+        """
+        Map a symbol file written by save_binary below the symbols already in
+        the table. A previously mapped file is replaced
+        """
+        with self._lock:
+            self._mapped = MappedSymbols(filename)
+            self._flat = None
+            self._iv_starts = None
+
+    def save_binary(self, filename):
+        write_symbol_file(filename, self.symbols)
+
+    def load_firmware_symbols(self, prefix):
+        """
+        Load the symbols belonging to a firmware image, given its path without extension
+
+        The binary symbol file (.symdb) is preferred. It is (re)generated from
+        the JSON (.sym.lz4, .sym) or Ghidra CSV (.csv) symbols if it is missing
+        or older than them. Returns False if no symbols are available.
+        """
+        symbols_db = prefix + ".symdb"
+        sources = [prefix + ".sym.lz4", prefix + ".sym", prefix + ".csv"]
+        sources = [path for path in sources if os.access(path, os.R_OK)]
+
+        if os.access(symbols_db, os.R_OK) and all(
+            os.path.getmtime(symbols_db) >= os.path.getmtime(path) for path in sources
+        ):
+            log.info("Mapping cached symbols from %s", symbols_db)
+
+            try:
+                self.load_binary(symbols_db)
+                log.info("Loaded %d symbols", len(self))
+                return True
+            except ValueError as e:
+                log.warning("Ignoring symbol file %s: %s", symbols_db, e)
+
+        if len(sources) == 0:
+            return False
+
+        path = sources[0]
+        loaded = SymbolTable()
+        log.info("Loading symbols from %s", path)
+
+        if path.endswith(".csv"):
+            loaded.load_ghidra_csv(path)
+        elif path.endswith(".lz4"):
+            loaded.load_compressed_json(path)
+        else:
+            loaded.load_json(path)
+
+        try:
+            log.info("Saving symbols to %s", symbols_db)
+            loaded.save_binary(symbols_db)
+            self.load_binary(symbols_db)
+        except (OSError, ValueError) as e:
+            log.warning("Unable to use symbol file %s: %s", symbols_db, e)
+            self._load(loaded.symbols, overwrite=False)
+
+        log.info("Loaded %d symbols", len(self))
+        return True
 
     def load_compressed_json(self, filename, overwrite=False):
         with open(filename, "rb") as fp:
             with lz4.frame.open(fp) as lzfp:
                 loaded_symbols = json.load(lzfp, object_hook=as_symbol)
 
-        if overwrite:
-            self.symbols = loaded_symbols
-        else:
-            self.symbols += loaded_symbols
-
-        self._sort()
-        self._build_name_table()
+        self._load(loaded_symbols, overwrite)
 
     def load_json(self, filename, overwrite=False):
         with open(filename, "r") as fp:
             loaded_symbols = json.load(fp, object_hook=as_symbol)
 
-        if overwrite:
-            self.symbols = loaded_symbols
-        else:
-            self.symbols += loaded_symbols
-
-        self._sort()
-        self._build_name_table()
+        self._load(loaded_symbols, overwrite)
 
     def save_json(self, filename):
-        self._sort()
-
         with open(filename, "w") as fp:
             json.dump(self.symbols, fp, cls=SymbolEncoder)
 
     def load_ghidra_csv(self, filename):
-        self.symbols = []
+        symbols = []
         addrs_seen = {}
 
+        # exports may have an additional size column (e.g. function bodies)
+        size_column = None
+
         with open(filename) as fp:
             for i, row in enumerate(csv.reader(fp, delimiter=",")):
                 if i == 0:
+                    for col, title in enumerate(row):
+                        if title in ["Size", "Function Size", "Length"]:
+                            size_column = col
                     continue
 
                 (
@@ -121,7 +459,7 @@ class SymbolTable(object):
                     source,
                     refcount,
                     offcut_refcount,
-                ) = row
+                ) = row[:7]
 
                 # GHIDRA generates these and they are pretty noisy and useless to have as symbol
                 # Example: "caseD_0","405fc714","Instruction Label","","switchD_405fc70a","Analysis","1","0"
@@ -148,46 +486,128 @@ class SymbolTable(object):
 
                 addrs_seen[location] = refcount
 
-                sym = Symbol(name, location, symbol_type_obj)
-                self.symbols += [sym]
+                size = 0
+
+                if size_column is not None:
+                    try:
+                        size = int(row[size_column], 0)
+                    except (ValueError, IndexError):
+                        pass
+
+                sym = Symbol(name, location, symbol_type_obj, size)
+                symbols += [sym]
+
+        self._load(symbols, overwrite=True)
 
-        self._sort()
-        self._build_name_table()
+    def _load(self, symbols, overwrite):
+        with self._lock:
+            if not overwrite:
+                symbols = self.symbols + symbols
 
-    def add(self, name, location, ty=SymbolType.LABEL):
-        sym = Symbol(name, location, ty)
-        self.by_name[sym.name] = self.by_name.get(sym.name, []) + [sym]
+            self._mapped = None
+            self._rebuild(symbols)
+            self._build_name_table()
+
+    def add(self, name, location, ty=SymbolType.LABEL, size=0):
+        sym = Symbol(name, location, ty, size)
+        self.by_name.setdefault(sym.name, []).append(sym)
         self._insert_symbol_inorder(sym)
         return sym
 
-    def set(self, name, location, ty=SymbolType.LABEL):
-        sym = Symbol(name, location, ty)
+    def add_many(self, entries, ty=SymbolType.LABEL):
+        """
+        Add (name, location) or (name, location, size) tuples in one batch and
+        return the new symbols
+
+        Unlike repeated calls to add, new symbols are placed after all existing
+        symbols at the same address, in the order given (like loading them).
+        """
+        new_symbols = [Symbol(entry[0], entry[1], ty, *entry[2:]) for entry in entries]
+
+        for sym in new_symbols:
+            self.by_name.setdefault(sym.name, []).append(sym)
+
+        # a merge is cheaper than many inserts for large batches
+        if len(new_symbols) > self._len // 8:
+            # the mapped symbols stay mapped
+            self._rebuild([sym for block in self._syms for sym in block] + new_symbols)
+        else:
+            for sym in new_symbols:
+                self._insert_at(self._bisect(sym.address, right=True), sym)
+
+        return new_symbols
+
+    def set(self, name, location, ty=SymbolType.LABEL, size=0):
+        sym = Symbol(name, location, ty, size)
+        # mapped symbols of this name would be found first
+        self._hide_mapped(name)
         self.by_name[sym.name] = [sym]
         self._insert_symbol_inorder(sym)
         return sym
 
-    def replace(self, name, location, ty=SymbolType.LABEL):
+    def add_deferred(self, name, resolver):
+        """
+        Register a symbol whose address is only computed when it is first looked up by name
+
+        Deferred symbols are invisible to address lookups until they are resolved
+        """
+        self._deferred[name] = resolver
+
+    def resolve_deferred(self):
+        """Resolve all outstanding deferred symbols"""
+        for name in list(self._deferred):
+            self._resolve_deferred(name)
+
+    def is_deferred(self, name):
+        """True if name is a deferred symbol which was not resolved yet"""
+        return name in self._deferred and not self._has_name(name)
+
+    def _resolve_deferred(self, name):
+        # the resolver stays registered if it fails, a later lookup retries
+        address = self._deferred[name]()
+        del self._deferred[name]
+
+        if address is not None and not self._has_name(name):
+            self.add(name, address)
+
+    def replace(self, name, location, ty=SymbolType.LABEL, size=0):
         self.remove(name)
-        self.add(name, location, ty)
+        self.add(name, location, ty, size)
 
     def remove(self, name):
-        if name not in self.by_name:
+        if name in self._deferred and not self._has_name(name):
+            del self._deferred[name]
+            return
+
+        if not self._has_name(name):
             raise ValueError("Cannot remove symbol %s: does not exist" % name)
 
-        symbols = self.by_name[name]
-        del self.by_name[name]
+        self._hide_mapped(name)
+        symbols = self.by_name.pop(name, [])
 
         for sym in symbols:
-            idx_to_delete = None
-            for idx, found_sym in self._find_by_address(sym.address):
+            pos_to_delete = None
+            for pos, found_sym in self._find_by_address(sym.address):
                 if id(found_sym) == id(sym):
-                    idx_to_delete = idx
+                    pos_to_delete = pos
                     break
 
-            assert idx_to_delete is not None
+            assert pos_to_delete is not None
+
+            self._delete_at(pos_to_delete)
+
+    def _hide_mapped(self, name):
+        with self._lock:
+            if self._mapped is None:
+                return
+
+            for idx in self._mapped.find_name(name):
+                self._mapped.remove(idx)
+
+                if self._mapped.sizes[idx]:
+                    self._iv_starts = None
 
-            # XXX: O(n) operation
-            del self.symbols[idx]
+            self._flat = None
 
     def lookup(self, where, **kwargs):
         if isinstance(where, str):
@@ -200,6 +620,9 @@ class SymbolTable(object):
     def _lookup_by_address(self, address, exact=False):
         sym = self._find_closest_by_address(address)
 
+        if self._mapped is not None:
+            sym = self._closest_with_mapped(address, sym)
+
         if sym is None:
             return None
 
@@ -209,9 +632,18 @@ class SymbolTable(object):
             return sym
 
     def _lookup_by_name(self, name, single=True):
-        if name in self.by_name:
-            syms = self.by_name[name]
+        if name in self._deferred and not self._has_name(name):
+            self._resolve_deferred(name)
+
+        syms = self.by_name.get(name)
 
+        if self._mapped is not None:
+            mapped = [self._mapped.symbol(i) for i in self._mapped.find_name(name)]
+
+            if mapped:
+                syms = mapped + (syms or [])
+
+        if syms:
             if single:
                 return syms[0]
 
@@ -219,78 +651,322 @@ class SymbolTable(object):
         else:
             return None
 
+    def _has_name(self, name):
+        if name in self.by_name:
+            return True
+
+        return self._mapped is not None and len(self._mapped.find_name(name)) > 0
+
+    def _closest_with_mapped(self, address, sym):
+        idx = self._mapped.closest(address)
+
+        if idx is None:
+            return sym
+
+        mapped_sym = self._mapped.symbol(idx)
+
+        if sym is None:
+            return mapped_sym
+
+        # mapped symbols come first at the same address
+        if mapped_sym.address == address or sym.address == address:
+            return mapped_sym if mapped_sym.address == address else sym
+
+        mapped_below = mapped_sym.address < address
+        below = sym.address < address
+
+        if mapped_below and below:
+            return sym if sym.address >= mapped_sym.address else mapped_sym
+        elif mapped_below or below:
+            return mapped_sym if mapped_below else sym
+        else:
+            return mapped_sym if mapped_sym.address <= sym.address else sym
+
     def _build_name_table(self):
         self.by_name = {}
 
         for sym in self.symbols:
-            self.by_name[sym.name] = self.by_name.get(sym.name, []) + [sym]
+            self.by_name.setdefault(sym.name, []).append(sym)
+
+    def _rebuild(self, symbols):
+        with self._lock:
+            # a stable sort keeps the order of symbols sharing an address
+            symbols = sorted(symbols, key=lambda x: x.address)
+            step = self.BLOCK_SIZE
+
+            self._syms = [symbols[i : i + step] for i in range(0, len(symbols), step)]
+            self._addrs = [array("Q", [s.address for s in b]) for b in self._syms]
+            self._maxes = [b[-1] for b in self._addrs]
+            self._len = len(symbols)
+            self._flat = symbols if self._mapped is None else None
+            self._iv_starts = None
+
+    def _bisect(self, address, right=False):
+        """(block, index) of the first symbol at or (when right) after address"""
+        if right:
+            block = bisect.bisect_right(self._maxes, address)
+        else:
+            block = bisect.bisect_left(self._maxes, address)
+
+        if block == len(self._maxes):
+            return (block, 0)
+
+        if right:
+            return (block, bisect.bisect_right(self._addrs[block], address))
+        else:
+            return (block, bisect.bisect_left(self._addrs[block], address))
+
+    def _at(self, pos):
+        block, idx = pos
+
+        if block == len(self._syms):
+            return None
+
+        return self._syms[block][idx]
+
+    def _prev(self, pos):
+        block, idx = pos
+
+        if idx > 0:
+            return (block, idx - 1)
+
+        return (block - 1, len(self._syms[block - 1]) - 1)
+
+    def _next(self, pos):
+        block, idx = pos
+
+        if idx + 1 < len(self._syms[block]):
+            return (block, idx + 1)
 
-    def _sort(self):
-        self.symbols = sorted(self.symbols, key=lambda x: x.address)
+        return (block + 1, 0)
 
     def _insert_symbol_inorder(self, new_sym):
-        if len(self.symbols) == 0:
-            self.symbols = [new_sym]
-            return
+        pos = self._bisect(new_sym.address)
+        sym = self._at(pos)
+
+        # NB: a new symbol goes right after the first one sharing its address
+        if sym is not None and sym.address == new_sym.address:
+            pos = self._next(pos)
+
+        self._insert_at(pos, new_sym)
+
+    def _insert_at(self, pos, sym):
+        with self._lock:
+            block, idx = pos
+            self._flat = None
+            self._len += 1
+
+            if sym.size:
+                self._iv_starts = None
+
+            if len(self._syms) == 0:
+                self._syms = [[sym]]
+                self._addrs = [array("Q", [sym.address])]
+                self._maxes = [sym.address]
+                return
+
+            # append past the end to the last block
+            if block == len(self._syms):
+                block -= 1
+                idx = len(self._syms[block])
+
+            syms = self._syms[block]
+            addrs = self._addrs[block]
+
+            syms.insert(idx, sym)
+            addrs.insert(idx, sym.address)
+            self._maxes[block] = addrs[-1]
+
+            if len(syms) > 2 * self.BLOCK_SIZE:
+                half = len(syms) // 2
+                self._syms[block : block + 1] = [syms[:half], syms[half:]]
+                self._addrs[block : block + 1] = [addrs[:half], addrs[half:]]
+                self._maxes[block : block + 1] = [addrs[half - 1], addrs[-1]]
+
+    def _delete_at(self, pos):
+        with self._lock:
+            block, idx = pos
+            self._flat = None
+            self._len -= 1
+
+            syms = self._syms[block]
+            addrs = self._addrs[block]
+
+            if syms[idx].size:
+                self._iv_starts = None
+
+            del syms[idx]
+            del addrs[idx]
+
+            if len(syms) == 0:
+                del self._syms[block]
+                del self._addrs[block]
+                del self._maxes[block]
+            else:
+                self._maxes[block] = addrs[-1]
 
-        idx = self._find_index_by_address(new_sym.address)
+    def lookup_containing(self, address):
+        """The innermost sized symbol containing address or None"""
+        self._build_intervals()
 
-        # XXX: very expensive (O(n))
-        # Use something like blist which is a hybrid tree/array
-        if self.symbols[idx].address <= new_sym.address:
-            self.symbols = self.symbols[: idx + 1] + [new_sym] + self.symbols[idx + 1 :]
-        else:
-            self.symbols = self.symbols[:idx] + [new_sym] + self.symbols[idx:]
+        idx = bisect.bisect_right(self._iv_starts, address) - 1
 
-    def _find_index_by_address(self, address):
-        if len(self.symbols) == 0:
+        if idx < 0 or address >= self._iv_ends[idx]:
             return None
 
-        left = 0
-        right = len(self.symbols) - 1
+        return self._interval_symbol(idx)
 
-        while left < right:
-            mid = (right + left) // 2
-            symbol = self.symbols[mid]
-            last_idx = mid
+    def lookup_containing_many(self, addresses):
+        """lookup_containing for many addresses with a single sweep. Returns a list"""
+        self._build_intervals()
 
-            if symbol.address < address:
-                left = mid + 1
-            else:
-                right = mid
+        starts = self._iv_starts
+        ends = self._iv_ends
+        results = [None] * len(addresses)
+        idx = 0
 
-        idx = left
-        symbol = self.symbols[idx]
+        for i in sorted(range(len(addresses)), key=addresses.__getitem__):
+            address = addresses[i]
 
-        offset = address - symbol.address
+            while idx < len(starts) and ends[idx] <= address:
+                idx += 1
 
-        if offset < 0 and left > 0:
-            return idx - 1
-        else:
-            return idx
+            if idx < len(starts) and starts[idx] <= address:
+                results[i] = self._interval_symbol(idx)
+
+        return results
+
+    def symbolize(self, address, max_offset=0x1000):
+        """
+        The symbol an address belongs to for display purposes or None
+
+        Symbols without a size are assumed to cover up to max_offset bytes
+        """
+        sym = self.lookup_containing(address)
+
+        if sym is not None:
+            return sym
+
+        return self._symbolize_unsized(address, max_offset)
+
+    def symbolize_many(self, addresses, max_offset=0x1000):
+        """symbolize for many addresses, sized symbols are found with one sweep"""
+        with self._lock:
+            results = self.lookup_containing_many(addresses)
+
+            for i, sym in enumerate(results):
+                if sym is None:
+                    results[i] = self._symbolize_unsized(addresses[i], max_offset)
+
+            return results
+
+    def _symbolize_unsized(self, address, max_offset):
+        sym = self._lookup_by_address(address)
+
+        if sym is None or sym.size or abs(address - sym.address) >= max_offset:
+            return None
+
+        return sym
+
+    def _interval_symbol(self, idx):
+        owner = self._iv_owners[idx]
+
+        # mapped symbols are only materialised here
+        if isinstance(owner, int):
+            return self._mapped.symbol(owner)
+
+        return owner
+
+    def _build_intervals(self):
+        with self._lock:
+            self._build_intervals_locked()
+
+    def _build_intervals_locked(self):
+        if self._iv_starts is not None:
+            return
+
+        intervals = []
+
+        if self._mapped is not None:
+            mapped = self._mapped
+
+            for idx, size in enumerate(mapped.sizes):
+                if size and not mapped._removed[idx]:
+                    start = mapped.addrs[idx]
+                    intervals += [(start, start + size, idx)]
+
+        for block in self._syms:
+            for sym in block:
+                if sym.size:
+                    intervals += [(sym.address, sym.address + sym.size, sym)]
+
+        # outer symbols first, so inner ones take over their range
+        intervals.sort(key=lambda x: (x[0], -x[1]))
+
+        starts = array("Q")
+        ends = array("Q")
+        owners = []
+        # enclosing (end, owner) not yet closed
+        stack = []
+        pos = 0
+
+        def emit(end, owner):
+            nonlocal pos
+
+            if end > pos:
+                starts.append(pos)
+                ends.append(end)
+                owners.append(owner)
+                pos = end
+
+        for start, end, owner in intervals:
+            while stack and stack[-1][0] <= start:
+                emit(*stack.pop())
+
+            if stack:
+                emit(start, stack[-1][1])
+
+            stack += [(end, owner)]
+            pos = start
+
+        while stack:
+            emit(*stack.pop())
+
+        # _iv_starts last, it marks the index as built
+        self._iv_ends = ends
+        self._iv_owners = owners
+        self._iv_starts = starts
 
     def _find_by_address(self, address):
-        symbols = []
-        idx = self._find_index_by_address(address)
+        if self._len == 0:
+            return
 
-        if idx is None:
-            return (0, 0)
+        pos = self._bisect(address)
 
-        while idx < len(self.symbols):
-            sym = self.symbols[idx]
-            if sym.address == address:
-                yield (idx, sym)
-                idx += 1
-            else:
+        while pos[0] < len(self._syms):
+            sym = self._at(pos)
+
+            if sym.address != address:
                 break
 
-    def _find_closest_by_address(self, address):
-        idx = self._find_index_by_address(address)
+            yield (pos, sym)
+            pos = self._next(pos)
 
-        if idx is None:
+    def _find_closest_by_address(self, address):
+        if self._len == 0:
             return None
 
-        return self.symbols[idx]
+        pos = self._bisect(address)
+        sym = self._at(pos)
+
+        if sym is not None and sym.address == address:
+            return sym
+
+        # before the first symbol, the first symbol is the closest
+        if pos == (0, 0):
+            return sym
+
+        return self._at(self._prev(pos))
 
 
 class SymbolEncoder(json.JSONEncoder):
@@ -298,7 +974,12 @@ class SymbolEncoder(json.JSONEncoder):
         if type(obj) == SymbolType:
             return {"E": int(obj)}
         elif type(obj) == Symbol:
-            return {"S": {"A": obj.address, "N": obj.name, "T": obj.symbol_ty}}
+            sym = {"A": obj.address, "N": obj.name, "T": obj.symbol_ty}
+
+            if obj.size:
+                sym["Z"] = obj.size
+
+            return {"S": sym}
         return json.JSONEncoder.default(self, obj)
 
 
@@ -307,17 +988,26 @@ def as_symbol(d):
         return SymbolType(d["E"])
     elif "S" in d:
         d = d["S"]
-        return Symbol(d["N"], d["A"], SymbolType(d["T"]))
+        return Symbol(d["N"], d["A"], SymbolType(d["T"]), d.get("Z", 0))
     else:
         return d
 
 
 if __name__ == "__main__":
-    print("main")
+    # convert a Ghidra CSV or JSON symbol dump to a binary symbol file
+    if len(sys.argv) != 3:
+        print("usage: %s symbols.{csv,sym,sym.lz4} output.symdb" % sys.argv[0])
+        sys.exit(1)
+
     table = SymbolTable()
-    table.load_ghidra_csv("modem_symbols.csv")
-    print("Loaded %d symbols (csv)" % len(table.symbols))
-    table.save_json("a")
-    print("Saved %d symbols" % len(table.symbols))
-    table.load_json("a")
-    print("Loaded %d symbols (json)" % len(table.symbols))
+
+    if sys.argv[1].endswith(".csv"):
+        table.load_ghidra_csv(sys.argv[1])
+    elif sys.argv[1].endswith(".lz4"):
+        table.load_compressed_json(sys.argv[1])
+    else:
+        table.load_json(sys.argv[1])
+
+    print("Loaded %d symbols" % len(table))
+    table.save_binary(sys.argv[2])
+    print("Saved %d symbols to %s" % (len(table), sys.argv[2]))
@@ -0,0 +1,633 @@
+#!/usr/bin/env python3
+## Copyright (c) 2022, Team FirmWire
+## SPDX-License-Identifier: BSD-3-Clause
+"""
+Offline benchmark for load-time symbol resolution
+
+Builds synthetic Shannon/exy5400 TOC and MTK md1img images, plants a match for
+every pattern entry of the vendor PATTERNS and times PatternDB.find_patterns
+cold, warm and per pattern along with the peak Python memory use. Images are
+filled with random bytes and, like the padding and tables of real images,
+mostly zero bytes. Results are written as JSON so they can be compared across
+commits:
+
+    python3 tests/bench_patterndb.py --size 64 -o before.json
+    python3 tests/bench_patterndb.py --size 64 --baseline before.json
+"""
+import sys
+import re
+import json
+import lzma
+import time
+import random
+import struct
+import logging
+import argparse
+import platform
+import statistics
+import subprocess
+import tracemalloc
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parent.parent))
+
+import firmwire
+from firmwire.emulator.patterndb import PatternDB, PatternDBEntry
+from firmwire.util.symbol import SymbolTable
+from firmwire.util.BinaryPattern import BinaryPattern
+from firmwire.vendor.shannon.loader import ShannonLoader
+from firmwire.vendor.shannon.pattern import PATTERNS as SHANNON_PATTERNS
+from firmwire.vendor.exy5400.loader import Exy5400Loader
+from firmwire.vendor.exy5400.pattern import PATTERNS as EXY5400_PATTERNS
+from firmwire.vendor.mtk.loader import (
+    MTKLoader,
+    MAGIC,
+    MAGIC2,
+    MAIN_IMG_NAME,
+    DBG_INFO_NAME,
+)
+from firmwire.vendor.mtk.pattern import PATTERNS as MTK_PATTERNS
+from firmwire.vendor.mtk.consts import ROM_BASE_ADDR
+
+log = logging.getLogger("bench_patterndb")
+
+TOC_MAIN_ADDRESS = 0x40010000
+MTK_ROM_ADDRESS = 0x90000000 + ROM_BASE_ADDR
+
+# hex byte or one of the BinaryPattern wildcards
+PATTERN_TOKEN = re.compile(r"\?\?|\?\+|\?\*|[0-9a-fA-F]{2}")
+
+
+def concrete_bytes(pattern, rnd):
+    """Pick the shortest byte string matching a BinaryPattern hex pattern"""
+    out = bytearray()
+
+    for token in PATTERN_TOKEN.findall(re.sub(r"\s", "", pattern)):
+        if token in ["??", "?+"]:
+            out.append(rnd.randrange(256))
+        elif token != "?*":
+            out.append(int(token, 16))
+
+    return bytes(out)
+
+
+FILLS = ["random", "zero"]
+
+
+def fill_bytes(size, fill, rnd):
+    if fill == "random":
+        return bytearray(rnd.randbytes(size))
+    elif fill == "zero":
+        # zeros with a sprinkle of common Thumb halfwords (push, nop). Short
+        # literal runs of patterns hit almost everywhere in such data
+        words = [b"\x70\xb5", b"\x10\xb5", b"\x00\xbf", b"\x01\x00"]
+        return bytearray(
+            b"".join(
+                [rnd.choice(words) + bytes(0xE) for _ in range(size // 0x10)]
+            ).ljust(size, b"\x00")
+        )
+
+    raise ValueError("Unknown fill %s" % fill)
+
+
+class SyntheticImage:
+    """Filler bytes with known matches for PatternDB entries planted in it"""
+
+    def __init__(self, size, base, rnd, fill="random"):
+        self.rnd = rnd
+        self.base = base
+        self.data = fill_bytes(size, fill, rnd)
+        self.cursor = 0x1000
+        self.expected = {}
+        # (offset, bytes) of every planted match outside of functions
+        self._sites = []
+        # MTK functions that `within` entries are restricted to
+        self.functions = {}
+        self._function_cursor = {}
+
+    def reserve(self, length):
+        off = self.cursor
+
+        if off + length > len(self.data):
+            raise ValueError("Synthetic image is too small for all patterns")
+
+        self.cursor = (off + length + 0x3F) & ~0x3F
+        return off
+
+    def put(self, off, data):
+        self.data[off : off + len(data)] = data
+
+    def plant(self, name, entry):
+        patterns = entry["pattern"]
+
+        if isinstance(patterns, str):
+            patterns = [patterns]
+
+        if "within" not in entry:
+            # some patterns are part of others (DSP_SYNC_WORD_0/1)
+            loc = self._find_in_sites(patterns[0], entry.get("align"))
+
+            if loc is not None:
+                self.expected[name] = self._address(entry, *loc)
+                return
+
+        match = concrete_bytes(patterns[0], self.rnd)
+
+        if "within" in entry:
+            off = self._reserve_within(entry["within"], len(match))
+        else:
+            # zeros around the match, so that variable wildcards (up to 100
+            # bytes) cannot start in the filler before it
+            guard = 0x80
+            off = self.reserve(len(match) + 2 * guard)
+            self.put(off, bytes(len(match) + 2 * guard))
+            off += guard
+            self._sites += [(off, match)]
+
+        self.put(off, match)
+        self.expected[name] = self._address(entry, off, off + len(match))
+
+    def _address(self, entry, start, end):
+        if "offset" in entry:
+            return self.base + start + entry["offset"]
+        elif "offset_end" in entry:
+            return self.base + end + entry["offset_end"]
+        else:
+            return self.base + start
+
+    def _find_in_sites(self, pattern, align):
+        bp = BinaryPattern("site")
+        bp.from_hex(pattern)
+
+        for off, match in self._sites:
+            for start, end in bp.findall(match):
+                if align is None or (off + start) % align == 0:
+                    return (off + start, off + end)
+
+        return None
+
+    def _reserve_within(self, function, length):
+        if function not in self.functions:
+            size = 0x400
+            start = self.reserve(size)
+            # no random bytes inside functions, short patterns would match them
+            self.put(start, bytes(size))
+            self.functions[function] = (self.base + start, size)
+            self._function_cursor[function] = start + 0x20
+
+        off = self._function_cursor[function]
+        self._function_cursor[function] = off + ((length + 0x1F) & ~0xF)
+
+        start, size = self.functions[function]
+
+        if off + length > start - self.base + size:
+            raise ValueError("Too many patterns within %s" % function)
+
+        return off
+
+    def plant_all(self, patterns, soc_name=None):
+        for name, entry in patterns.items():
+            # lookup handlers search for their own structures
+            if "pattern" not in entry:
+                continue
+
+            if "soc_match" in entry and soc_name not in entry["soc_match"]:
+                continue
+
+            self.plant(name, entry)
+
+
+def build_toc(main, load_address):
+    header_size = 0x200
+    sections = [
+        ("TOC", 0, 0, header_size),
+        ("MAIN", header_size, load_address, len(main)),
+    ]
+
+    header = b"".join(
+        [
+            struct.pack("<12siiiii", name.encode(), offset, address, size, 0, 0)
+            for name, offset, address, size in sections
+        ]
+    )
+
+    return header.ljust(header_size, b"\x00") + bytes(main)
+
+
+def build_md1img(sections):
+    out = bytearray()
+
+    for name, data, address in sections:
+        data_off = 0x200
+        header = struct.pack(
+            "<II32sIIIIIIIIII",
+            MAGIC,
+            len(data),
+            name.encode(),
+            address,
+            0,
+            MAGIC2,
+            data_off,
+            *([0] * 6)
+        )
+        out += header.ljust(data_off, b"\x00") + data
+        out += b"\x00" * (-len(out) % 0x10)
+
+    return bytes(out)
+
+
+def build_debug_info(functions):
+    out = bytearray(0x1C)
+
+    # target, hwplatform, moly_version, buildtime
+    for _ in range(4):
+        out += b"BENCH\x00"
+
+    table = b"".join(
+        [
+            name.encode() + b"\x00" + struct.pack("<II", start, start + size)
+            for name, (start, size) in functions.items()
+        ]
+    )
+
+    fn_syms_off = len(out) + 8
+    file_syms_off = fn_syms_off + len(table)
+    out += struct.pack("<II", fn_syms_off - 0x10, file_syms_off - 0x10) + table
+
+    return lzma.compress(bytes(out))
+
+
+class Scenario:
+    """A synthetic image loaded through the vendor loader"""
+
+    def __init__(self, name, workspace, loader, data, offset, patterns, expected):
+        self.name = name
+        self.workspace = workspace
+        self.loader = loader
+        self.data = data
+        self.offset = offset
+        self.patterns = patterns
+        self.expected = expected
+
+    def reset(self, keep_cache=False):
+        self.loader.symbol_table = SymbolTable()
+
+        if not keep_cache:
+            cache = self.workspace.path("/patterndb.cache").to_path()
+
+            if cache.exists():
+                cache.unlink()
+
+
+class MTKScenario(Scenario):
+    def __init__(self, *args, functions):
+        super().__init__(*args)
+        self.functions = functions
+
+    def reset(self, keep_cache=False):
+        super().reset(keep_cache=keep_cache)
+        self.loader.load_debug_symbols(self.functions)
+
+
+def prepare_shannon(workspace, size, rnd, fill):
+    image = SyntheticImage(size, TOC_MAIN_ADDRESS, rnd, fill)
+    # needed by guess_soc_version and the S5000AP DSP base search
+    image.put(0, b"S5000AP_20200101\x00")
+    image.put(0x20, struct.pack("<I", 0x47382000) + b"DSP_SUBSYS_CRTLDSP\x00")
+    image.plant_all(SHANNON_PATTERNS, "S5000AP")
+
+    path = workspace.base_path() / "shannon.bin"
+    path.write_bytes(build_toc(image.data, TOC_MAIN_ADDRESS))
+
+    loader = ShannonLoader(str(path), workspace)
+    assert loader.toc_load_modem_file(str(path)) and loader.guess_soc_version()
+    main = loader.modem_file.get_section("MAIN")
+
+    return Scenario(
+        "shannon",
+        workspace,
+        loader,
+        main.data,
+        main.load_address,
+        SHANNON_PATTERNS,
+        image.expected,
+    )
+
+
+def prepare_exy5400(workspace, size, rnd, fill):
+    image = SyntheticImage(size, TOC_MAIN_ADDRESS, rnd, fill)
+    image.plant_all(EXY5400_PATTERNS, "S5123AP")
+
+    path = workspace.base_path() / "exy5400.bin"
+    path.write_bytes(build_toc(image.data, TOC_MAIN_ADDRESS))
+
+    loader = Exy5400Loader(str(path), workspace, is_s24=True)
+    assert loader.toc_load_modem_file(str(path)) and loader.guess_soc_version()
+    main = loader.modem_file.get_section("MAIN")
+
+    return Scenario(
+        "exy5400",
+        workspace,
+        loader,
+        main.data,
+        main.load_address,
+        EXY5400_PATTERNS,
+        image.expected,
+    )
+
+
+def prepare_mtk(workspace, size, rnd, fill):
+    image = SyntheticImage(size, MTK_ROM_ADDRESS, rnd, fill)
+    image.plant_all(MTK_PATTERNS)
+
+    path = workspace.base_path() / "md1img.img"
+    path.write_bytes(
+        build_md1img(
+            [
+                (MAIN_IMG_NAME, bytes(image.data), 0),
+                (DBG_INFO_NAME, build_debug_info(image.functions), 0),
+            ]
+        )
+    )
+
+    loader = MTKLoader(str(path), workspace)
+    loader.md1img = str(path)
+    loader.sections = {s.name: s for s in loader.iter_section_info()}
+    debug_info = loader.parse_debug_info()
+
+    return MTKScenario(
+        "mtk",
+        workspace,
+        loader,
+        loader.rom_img_data(),
+        MTK_ROM_ADDRESS,
+        MTK_PATTERNS,
+        image.expected,
+        functions={name: v for name, v in debug_info.items()},
+    )
+
+
+SCENARIOS = {
+    "shannon": prepare_shannon,
+    "exy5400": prepare_exy5400,
+    "mtk": prepare_mtk,
+}
+
+
+def bench_entries(patterns):
+    """
+    PatternDB entries without post_lookup handlers and the required flag
+
+    post_lookup handlers parse real firmware structures which a synthetic image
+    does not have. They are side effects and not part of the search cost.
+    """
+    entries = []
+
+    for name, entry in patterns.items():
+        pat = PatternDBEntry(name)
+
+        for k, v in entry.items():
+            if k not in ["post_lookup", "required"]:
+                setattr(pat, k, v)
+
+        entries += [pat]
+
+    return entries
+
+
+def resolve(scenario, entries, jobs=1, keep_cache=False):
+    """Run find_patterns once and return (seconds, {name: address})"""
+    scenario.reset(keep_cache=keep_cache)
+
+    db = PatternDB(scenario.loader, jobs=jobs)
+
+    for entry in entries:
+        db.add_pattern(entry)
+
+    start = time.perf_counter()
+    db.find_patterns(scenario.data, scenario.offset)
+    elapsed = time.perf_counter() - start
+
+    found = {}
+
+    for entry in entries:
+        sym = scenario.loader.symbol_table.lookup(entry.name)
+        found[entry.name] = sym.address if sym is not None else None
+
+    return elapsed, found
+
+
+def summarize(times):
+    return {"min": min(times), "median": statistics.median(times), "runs": times}
+
+
+def bench_scenario(scenario, repeat=3, jobs=1):
+    entries = bench_entries(scenario.patterns)
+
+    cold = []
+    warm = []
+
+    for _ in range(repeat):
+        elapsed, found = resolve(scenario, entries, jobs=jobs)
+        cold += [elapsed]
+
+        elapsed, warm_found = resolve(scenario, entries, jobs=jobs, keep_cache=True)
+        warm += [elapsed]
+
+    tracemalloc.start()
+
+    try:
+        resolve(scenario, entries, jobs=jobs)
+        peak_memory = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    patterns = {}
+    mismatches = []
+
+    for entry in entries:
+        elapsed, _ = resolve(scenario, [entry])
+        expected = scenario.expected.get(entry.name)
+
+        patterns[entry.name] = {
+            "seconds": elapsed,
+            "planted": entry.name in scenario.expected,
+            "expected": expected,
+            "found": found[entry.name],
+        }
+
+        if expected is not None and found[entry.name] != expected:
+            mismatches += [entry.name]
+
+    return {
+        "image_size": len(scenario.data),
+        "entries": len(entries),
+        "planted": len(scenario.expected),
+        "cold_seconds": summarize(cold),
+        "warm_seconds": summarize(warm),
+        "warm_matches_cold": warm_found == found,
+        "peak_memory_bytes": peak_memory,
+        "mismatches": mismatches,
+        "patterns": patterns,
+    }
+
+
+def git_revision():
+    try:
+        return (
+            subprocess.check_output(
+                ["git", "rev-parse", "HEAD"],
+                cwd=str(Path(__file__).parent),
+                stderr=subprocess.DEVNULL,
+            )
+            .decode()
+            .strip()
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(vendors, size, seed=0, repeat=3, jobs=1, fills=FILLS):
+    results = {
+        "meta": {
+            "revision": git_revision(),
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "size": size,
+            "seed": seed,
+            "repeat": repeat,
+            "jobs": jobs,
+            "fills": list(fills),
+        },
+        "results": {},
+    }
+
+    for vendor in vendors:
+        for fill in fills:
+            workspace = firmwire.ScratchWorkspace()
+            workspace.create()
+
+            scenario = SCENARIOS[vendor](workspace, size, random.Random(seed), fill)
+            # random filled results keep the plain vendor name of older results
+            key = vendor if fill == "random" else "%s-%s" % (vendor, fill)
+            log.info("Benchmarking %s (%d bytes)", key, len(scenario.data))
+            results["results"][key] = bench_scenario(scenario, repeat=repeat, jobs=jobs)
+
+    return results
+
+
+def compare(baseline, current, threshold):
+    """Return a list of regressions of current against baseline"""
+    regressions = []
+
+    def check(what, old, new):
+        # ignore noise on very fast runs
+        if new > old * threshold and new - old > 0.01:
+            regressions.append("%s: %.3fs -> %.3fs" % (what, old, new))
+
+    for vendor, new in current["results"].items():
+        old = baseline["results"].get(vendor)
+
+        if old is None:
+            continue
+
+        check(vendor + " cold", old["cold_seconds"]["min"], new["cold_seconds"]["min"])
+        check(vendor + " warm", old["warm_seconds"]["min"], new["warm_seconds"]["min"])
+
+        for name, pat in new["patterns"].items():
+            old_pat = old["patterns"].get(name)
+
+            if old_pat is None:
+                continue
+
+            check("%s %s" % (vendor, name), old_pat["seconds"], pat["seconds"])
+
+            if old_pat["found"] != pat["found"]:
+                regressions.append(
+                    "%s %s: resolved to %s instead of %s"
+                    % (vendor, name, pat["found"], old_pat["found"])
+                )
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument(
+        "--vendor",
+        action="append",
+        choices=list(SCENARIOS.keys()),
+        help="Vendor image to benchmark (default: all)",
+    )
+    parser.add_argument(
+        "--size", type=int, default=32, help="Synthetic image size in MiB"
+    )
+    parser.add_argument(
+        "--fill",
+        action="append",
+        choices=FILLS,
+        help="Filler of the synthetic images (default: all)",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--jobs", type=int, default=1, help="PatternDB worker count")
+    parser.add_argument("-o", "--output", help="Write the JSON results here")
+    parser.add_argument("--baseline", help="JSON results to compare against")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=1.25,
+        help="Slowdown factor against the baseline that counts as a regression",
+    )
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO if args.verbose else logging.WARNING,
+        format="[%(levelname)s] %(message)s",
+    )
+    log.setLevel(logging.INFO)
+
+    results = run_benchmark(
+        args.vendor or list(SCENARIOS.keys()),
+        args.size * 1024 * 1024,
+        seed=args.seed,
+        repeat=args.repeat,
+        jobs=args.jobs,
+        fills=args.fill or FILLS,
+    )
+
+    if args.output:
+        with open(args.output, "w") as fp:
+            json.dump(results, fp, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+
+    for vendor, res in results["results"].items():
+        log.info(
+            "%s: cold %.3fs, warm %.3fs, peak %.1f MiB, %d/%d planted patterns resolved",
+            vendor,
+            res["cold_seconds"]["min"],
+            res["warm_seconds"]["min"],
+            res["peak_memory_bytes"] / (1024 * 1024),
+            res["planted"] - len(res["mismatches"]),
+            res["planted"],
+        )
+
+    failed = any([len(res["mismatches"]) for res in results["results"].values()])
+
+    if args.baseline:
+        with open(args.baseline) as fp:
+            regressions = compare(json.load(fp), results, args.threshold)
+
+        for regression in regressions:
+            log.error("Regression %s", regression)
+
+        failed = failed or len(regressions) > 0
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
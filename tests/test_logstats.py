@@ -0,0 +1,88 @@
+import sys
+import threading
+from pathlib import Path
+sys.path.append(str(Path(__file__).parent.parent))
+
+from firmwire.emulator.logstats import LogStats
+from firmwire.util.symbol import SymbolTable
+
+
+class Machine:
+    def __init__(self):
+        self.symbol_table = SymbolTable()
+        self.symbol_table.add("log_fn", 0x1000, size=0x100)
+
+    def time_running(self):
+        return 1.5
+
+
+def test_snapshot():
+    stats = LogStats(Machine())
+
+    for _ in range(3):
+        stats.count_line("LTE_RRC", 0x1010, False)
+
+    stats.count_line("LTE_RRC", 0x1010, True)
+    stats.count_line("SIM", 0x1010, True)
+    stats.count_line("SIM", None, False)
+    stats.count_peripheral("UART", False)
+    stats.count_peripheral("UART", True)
+    stats.count_peripheral("UART", True)
+
+    snap = stats.snapshot()
+
+    assert snap["time"] == 1.5
+    assert snap["emitted"] == 4
+    assert snap["omitted"] == 2
+    assert list(snap["tasks"]) == ["LTE_RRC", "SIM"]
+    assert snap["tasks"]["LTE_RRC"] == {"emitted": 3, "omitted": 1}
+    assert snap["tasks"]["SIM"] == {"emitted": 1, "omitted": 1}
+
+    callsite = snap["callsites"][0]
+    assert callsite["address"] == 0x1010
+    assert callsite["symbol"] == "log_fn+0x10"
+    assert callsite["emitted"] == 3 and callsite["omitted"] == 2
+    assert sorted(callsite["tasks"]) == ["LTE_RRC", "SIM"]
+    assert snap["callsites"][1]["address"] is None
+
+    assert snap["peripherals"] == {"UART": {"reads": 1, "writes": 2}}
+
+
+def test_format_table():
+    stats = LogStats(Machine())
+    stats.count_line("LTE_RRC", 0x1010, False)
+    stats.count_line("SIM", 0x2000, True)
+    stats.count_peripheral("UART", False)
+
+    table = stats.format_table(top=1)
+
+    assert table.startswith(
+        "Log statistics after 1.50 seconds: 1 lines emitted, 1 omitted"
+    )
+    assert "LTE_RRC" in table
+    assert "log_fn+0x10 (0x1010)" in table
+    assert "UART" in table
+    # only the top entry of each table
+    assert "SIM" not in table and "0x2000" not in table
+
+
+def test_counting_is_on_by_default():
+    stats = LogStats(Machine())
+    assert stats.enabled
+
+
+def test_snapshot_waits_for_symbol_changes():
+    machine = Machine()
+    stats = LogStats(machine)
+    stats.count_line("TASK", 0x1010, False)
+    snaps = []
+
+    # held by the emulation thread while it adds or resolves symbols
+    with machine.symbol_table._lock:
+        dumper = threading.Thread(target=lambda: snaps.append(stats.snapshot()))
+        dumper.start()
+        dumper.join(0.2)
+        assert dumper.is_alive()
+
+    dumper.join(5)
+    assert snaps[0]["callsites"][0]["symbol"] == "log_fn+0x10"
@@ -0,0 +1,112 @@
+import sys
+import threading
+from pathlib import Path
+sys.path.append(str(Path(__file__).parent.parent))
+
+from firmwire.emulator.logwriter import (
+    AsyncLogWriter,
+    SyncLogWriter,
+    create_log_writer,
+)
+
+
+class BlockingSink:
+    """Collects lines. Writes wait until release() once block() was called"""
+
+    def __init__(self):
+        self.lines = []
+        self.entered = threading.Event()
+        self.released = threading.Event()
+        self.released.set()
+
+    def block(self):
+        self.released.clear()
+        self.entered.clear()
+
+    def release(self):
+        self.released.set()
+
+    def write_lines(self, lines):
+        self.entered.set()
+        self.released.wait()
+        self.lines += lines
+
+    def close(self):
+        pass
+
+
+def test_drop_policy():
+    sink = BlockingSink()
+    writer = AsyncLogWriter(sink, capacity=2, policy="drop")
+
+    sink.block()
+    writer.write("a")
+    # the writer thread holds "a" in the blocked sink
+    assert sink.entered.wait(5)
+
+    writer.write("b")
+    writer.write("c")
+    writer.write("d")
+    assert writer.dropped == 1
+
+    sink.release()
+    assert writer.flush(timeout=5)
+    writer.write("e")
+    writer.close(timeout=5)
+
+    assert sink.lines == ["a", "b", "c", "[1 log lines dropped]", "e"]
+
+
+def test_block_policy():
+    sink = BlockingSink()
+    writer = AsyncLogWriter(sink, capacity=1, policy="block")
+
+    sink.block()
+    writer.write("a")
+    assert sink.entered.wait(5)
+    writer.write("b")
+
+    blocked = threading.Thread(target=writer.write, args=("c",))
+    blocked.start()
+    blocked.join(0.2)
+    assert blocked.is_alive()
+
+    sink.release()
+    blocked.join(5)
+    assert not blocked.is_alive()
+
+    writer.close(timeout=5)
+    assert sink.lines == ["a", "b", "c"]
+    assert writer.dropped == 0
+
+
+def test_flush_timeout():
+    sink = BlockingSink()
+    writer = AsyncLogWriter(sink)
+
+    sink.block()
+    writer.write("a")
+    assert sink.entered.wait(5)
+    assert not writer.flush(timeout=0.05)
+
+    sink.release()
+    assert writer.flush(timeout=5)
+    writer.close(timeout=5)
+    assert sink.lines == ["a"]
+
+
+def test_stdout_is_synchronous(tmp_path):
+    assert isinstance(create_log_writer(), SyncLogWriter)
+
+    writer = create_log_writer(path=str(tmp_path / "guest.log"))
+    assert isinstance(writer, AsyncLogWriter)
+    writer.close()
+
+    writer = create_log_writer(path=str(tmp_path / "guest.log"), sync=True)
+    assert isinstance(writer, SyncLogWriter)
+    writer.close()
+
+    # opt-in background writes to stdout
+    writer = create_log_writer(sync=False)
+    assert isinstance(writer, AsyncLogWriter)
+    writer.close()
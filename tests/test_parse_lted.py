@@ -0,0 +1,86 @@
+import sys
+import random
+import struct
+from io import BytesIO
+from functools import partial
+from pathlib import Path
+sys.path.append(str(Path(__file__).parent.parent))
+
+from firmwire.vendor.mtk.mtkdb import parse_lted
+
+GROUP_SIZE = 0x2000
+# group parsers are replaced by plain database reads of these groups
+GROUP_DBS = {"trace": 0, "message": 1, "struct": 2, "union": 3, "enum": 4, "typedef": 6}
+
+
+def make_table(buf, rnd):
+    """Append a table of small row blocks to buf. Returns its (size, offset)"""
+    buf += b"\x00" * (-len(buf) % 16)
+    offset = len(buf)
+    blocks = rnd.randint(1, 4)
+    table = bytearray(GROUP_SIZE * (blocks + 1))
+
+    # groupsize = (unk6 * 12 + 32) & ~0xfff
+    struct.pack_into("<HHIII", table, 0, 0, 0, 1, 0, 0)
+    struct.pack_into("<II", table, 16, 0, (GROUP_SIZE - 32) // 12 + 1)
+
+    for n in range(1, blocks + 1):
+        base = GROUP_SIZE * n
+        rows = []
+        pos = 0x40
+
+        for _ in range(rnd.randint(0, 20)):
+            row = bytes(rnd.getrandbits(8) for _ in range(rnd.randint(0, 32)))
+            table[base + pos : base + pos + len(row)] = row
+            rows += [(pos, len(row))]
+            pos += len(row)
+
+        struct.pack_into("<HHIII", table, base, n, 0, 3, len(rows), 0)
+
+        for q, (row_offset, row_size) in enumerate(rows):
+            struct.pack_into(
+                "<II", table, base + GROUP_SIZE - 8 * (len(rows) - q), row_offset, row_size
+            )
+
+    buf += table
+    return (GROUP_SIZE * (blocks + 1), offset)
+
+
+def make_lted(rnd):
+    dbs = max(GROUP_DBS.values()) + 1
+    buf = bytearray(b"LTED" + struct.pack("<II", 0, dbs) + b"\x00" * (dbs * 4))
+    entries = [[make_table(buf, rnd) for _ in range(3)] for _ in range(dbs)]
+    heads = []
+
+    for tables in entries:
+        buf += b"\x00" * (-len(buf) % 4)
+        heads += [len(buf)]
+        buf += b"HEAD" + struct.pack("<I", len(tables))
+        buf += b"".join([struct.pack("<II", o, s) for s, o in tables])
+
+    struct.pack_into("<%dI" % dbs, buf, 12, *heads)
+    return bytes(buf), entries
+
+
+def read_group(dbid, data, entries):
+    return parse_lted.readDatabase(entries, dbid, data)
+
+
+def test_parallel_lted_equals_serial(monkeypatch):
+    data, entries = make_lted(random.Random(1))
+
+    for name, dbid in GROUP_DBS.items():
+        monkeypatch.setitem(parse_lted.LTED_GROUPS, name, partial(read_group, dbid))
+
+    assert parse_lted.readLTEDHeader(data) == entries
+
+    serial = parse_lted.readLTED(BytesIO(data), jobs=1)
+    assert list(serial) == list(parse_lted.LTED_GROUPS)
+
+    for name, dbid in GROUP_DBS.items():
+        assert serial[name] == parse_lted.readDatabase(entries, dbid, data)
+        assert len(serial[name][0]) > 0
+
+    streamed = dict(parse_lted.iterLTED(data, jobs=3))
+    assert streamed == serial
+    assert parse_lted.readLTED(BytesIO(data), jobs=3) == serial
@@ -0,0 +1,13 @@
+import sys
+from pathlib import Path
+sys.path.append(str(Path(__file__).parent))
+
+from bench_patterndb import run_benchmark
+
+def test_patterndb_synthetic():
+    results = run_benchmark(["shannon", "exy5400", "mtk"], 1024 * 1024, repeat=1)
+
+    for vendor, res in results["results"].items():
+        assert res["planted"] > 0, vendor
+        assert res["mismatches"] == [], vendor
+        assert res["warm_matches_cold"], vendor
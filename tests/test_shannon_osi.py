@@ -0,0 +1,72 @@
+import sys
+import struct
+from pathlib import Path
+sys.path.append(str(Path(__file__).parent.parent))
+
+from firmwire.util.symbol import SymbolTable
+from firmwire.vendor.shannon.osi import ShannonOSI
+from firmwire.vendor.shannon.task import SamsungTaskLayout
+
+L = SamsungTaskLayout
+SCHED_TABLE = 0x1000
+CUR_TASK_ID = 0x2000
+SUBTASK = 0x3000
+TASK = 0x4000
+NAMES = 0x5000
+
+
+class FakePanda:
+    def __init__(self, size):
+        self.mem = bytearray(size)
+        self.reads = 0
+
+    def physical_memory_read(self, address, size):
+        self.reads += 1
+        return bytes(self.mem[address : address + size])
+
+    def write_word(self, address, value):
+        self.mem[address : address + 4] = struct.pack("<I", value)
+
+    def write_string(self, address, s):
+        self.mem[address : address + len(s) + 1] = s + b"\x00"
+
+
+class FakeOSI(ShannonOSI):
+    def __init__(self):
+        self.panda = FakePanda(0x10000)
+        self.task_layout = L
+        self.task_name_cache = {}
+        self.task_name_cache_check = False
+        self.symbol_table = SymbolTable()
+        self.symbol_table.add("SYM_SCHEDULABLE_TASK_LIST", SCHED_TABLE)
+        self.symbol_table.add("SYM_CUR_TASK_ID", CUR_TASK_ID)
+
+        panda = self.panda
+        panda.write_word(CUR_TASK_ID, 1)
+        panda.write_word(SCHED_TABLE + 4, SUBTASK)
+        panda.mem[SUBTASK + L.SUBTASK_MAGIC_OFFSET : SUBTASK + L.SUBTASK_MAGIC_OFFSET + 4] = b"KSAT"
+        panda.write_word(SUBTASK + L.SUBTASK_TASK_P_OFFSET, TASK)
+        panda.write_word(TASK + L.TASK_NAME_PTR_OFFSET, NAMES)
+        panda.write_string(NAMES, b"LTE_RRC")
+        panda.write_string(NAMES + 0x100, b"NAS")
+
+
+def test_task_name_cache_follows_name_pointer():
+    osi = FakeOSI()
+    panda = osi.panda
+
+    assert osi.get_current_task_name(None) == "LTE_RRC"
+    uncached = panda.reads
+
+    panda.reads = 0
+    assert osi.get_current_task_name(None) == "LTE_RRC"
+    assert panda.reads < uncached
+
+    # the task id is reused without any hook telling the cache
+    panda.write_word(TASK + L.TASK_NAME_PTR_OFFSET, NAMES + 0x100)
+    assert osi.get_current_task_name(None) == "NAS"
+
+    osi.task_name_cache_clear()
+    panda.write_word(CUR_TASK_ID, 0x420)
+    assert osi.get_current_task_name(None) == "NO_TASK"
+    assert osi.get_current_task_name(None) == "NO_TASK"
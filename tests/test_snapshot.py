@@ -0,0 +1,256 @@
+import io
+import os
+import sys
+import pickle
+from pathlib import Path
+sys.path.append(str(Path(__file__).parent.parent))
+
+import pytest
+from avatar2 import MemoryRange
+from intervaltree import Interval, IntervalTree
+
+from firmwire.emulator.snapshot import (
+    QemuSnapshotManager,
+    RamSnapshotPool,
+    RAM_SNAPSHOT_BLOCK_SIZE,
+)
+from firmwire.emulator.snapstate import (
+    SnapshotBlobStore,
+    dump_snapshot_state,
+    load_snapshot_state,
+)
+
+
+def blobs(path):
+    return sorted(os.listdir(path)) if os.path.isdir(path) else []
+
+
+def test_round_trip_shares_buffers(tmp_path):
+    store = SnapshotBlobStore(tmp_path / "blobs")
+    fifo = list(range(256)) * 32
+    mem = bytearray(b"\x01" * 0x2000)
+    state = {
+        "fifo": fifo,
+        "mem": mem,
+        "mem_alias": mem,
+        "copy": bytes(mem),
+        "small": [1, 2, 3],
+        "bools": [True] * 0x2000,
+    }
+
+    fp = io.BytesIO()
+    digests = dump_snapshot_state(state, fp, store)
+    # mem and its bytes copy have the same content
+    assert len(digests) == 2
+    assert len(blobs(store.path)) == 2
+
+    fp.seek(0)
+    loaded = load_snapshot_state(fp, store)
+    assert loaded == state
+    assert loaded["mem"] is loaded["mem_alias"]
+    assert type(loaded["mem"]) is bytearray
+    assert type(loaded["copy"]) is bytes
+    assert type(loaded["bools"][0]) is bool
+
+
+def test_plain_pickle_loads(tmp_path):
+    # v2 snapinfo files are plain pickles
+    state = {"version": 2, "peripherals": {"uart": {"fifo": [0] * 0x2000}}}
+    fp = io.BytesIO(pickle.dumps(state))
+
+    assert load_snapshot_state(fp, SnapshotBlobStore(tmp_path)) == state
+
+
+def test_corrupt_blob(tmp_path):
+    store = SnapshotBlobStore(tmp_path)
+    fp = io.BytesIO()
+    (digest,) = dump_snapshot_state({"mem": bytes(0x2000)}, fp, store)
+
+    with open(store._blob_path(digest), "r+b") as blob:
+        blob.seek(-4, os.SEEK_END)
+        blob.write(b"\xff" * 4)
+
+    fp.seek(0)
+
+    with pytest.raises(pickle.UnpicklingError):
+        load_snapshot_state(fp, store)
+
+
+class FakeMonitor:
+    def __init__(self, result=""):
+        self.result = result
+
+    def execute_command(self, command, args):
+        return self.result
+
+
+def test_take_prunes_blobs(tmp_path):
+    manager = QemuSnapshotManager(str(tmp_path))
+    blob_path = manager.blob_store.path
+    metadata = {"reason": ""}
+
+    def take(name, fill, result=""):
+        peripherals = {"mem": [fill] * 0x2000, "rom": bytes(0x2000)}
+        return manager.take(name, FakeMonitor(result), peripherals, {}, metadata)
+
+    assert take("a", 1)
+    assert take("b", 2)
+    assert len(blobs(blob_path)) == 3
+
+    # retaking a snapshot drops the blobs only it used
+    assert take("a", 3)
+    assert len(blobs(blob_path)) == 3
+
+    # a failed savevm leaves nothing behind
+    assert not take("c", 4, result="Error: no space left")
+    assert not os.path.exists(tmp_path / "c.snapinfo")
+    assert len(blobs(blob_path)) == 3
+
+    os.unlink(tmp_path / "b.snapinfo")
+    manager.prune_blobs()
+    assert len(blobs(blob_path)) == 2
+
+    with open(tmp_path / "a.snapinfo", "rb") as fp:
+        state = load_snapshot_state(fp, manager.blob_store)
+
+    assert state["peripherals"]["mem"] == [3] * 0x2000
+
+    # unreadable snapinfo files keep everything
+    (tmp_path / "a.snapinfo").write_bytes(b"\x80\x05")
+    manager.blob_store.put(b"\x05" * 0x2000)
+    manager.prune_blobs()
+    assert len(blobs(blob_path)) == 3
+
+
+class FakePanda:
+    def __init__(self, size):
+        self.mem = bytearray(size)
+        self.reads = []
+        self.writes = []
+        self.flushes = 0
+
+    def physical_memory_read(self, address, size):
+        self.reads.append(address)
+        return bytes(self.mem[address : address + size])
+
+    def physical_memory_write(self, address, data):
+        self.writes.append(address)
+        self.mem[address : address + len(data)] = data
+
+    def flush_tb(self):
+        self.flushes += 1
+
+
+class FakeQemu:
+    def __init__(self):
+        self.registers = {"r0": 0, "pc": 0x1000}
+        self.writes = 0
+
+    def read_register(self, reg):
+        return self.registers[reg]
+
+    def write_register(self, reg, value):
+        self.writes += 1
+        self.registers[reg] = value
+
+
+class FakeArch:
+    registers = {"r0": 0, "pc": 15}
+
+
+class FakeAvatar:
+    def __init__(self, ranges):
+        self.arch = FakeArch()
+        self.memory_ranges = IntervalTree(
+            Interval(mr.address, mr.address + mr.size, mr) for mr in ranges
+        )
+
+
+class FakeMachine:
+    def __init__(self):
+        self.panda = FakePanda(0x100000)
+        self.qemu = FakeQemu()
+        self.avatar = FakeAvatar(
+            [
+                MemoryRange(0x0, 0x40000, name="ram"),
+                MemoryRange(0x40000, 0x10000, name="rom", file="modem.bin"),
+                MemoryRange(0x80000, 0x2000, name="gic", qemu_name="a9mpcore_priv"),
+                MemoryRange(
+                    0x90000,
+                    0x1000,
+                    name="uart",
+                    forwarded=True,
+                    python_peripheral=object(),
+                ),
+            ]
+        )
+
+
+def pool_take(pool, name, fill=0):
+    return pool.take(name, None, {"fifo": [fill] * 0x2000}, {}, {"reason": ""})
+
+
+def test_pool_ignores_devices():
+    machine = FakeMachine()
+    pool = RamSnapshotPool(machine, 1)
+
+    assert pool_take(pool, "a")
+    assert sorted(pool.snapshots["a"].ram) == [0x0, 0x40000]
+    assert all(address < 0x80000 for address in machine.panda.reads)
+
+
+def test_pool_shares_and_restores_blocks():
+    machine = FakeMachine()
+    panda = machine.panda
+    pool = RamSnapshotPool(machine, 2)
+
+    assert pool_take(pool, "a")
+    panda.mem[RAM_SNAPSHOT_BLOCK_SIZE + 5] = 1
+    assert pool_take(pool, "b")
+
+    a = pool.snapshots["a"].ram[0]
+    b = pool.snapshots["b"].ram[0]
+    assert [x is y for x, y in zip(a, b)] == [True, False, True, True]
+
+    panda.mem[2 * RAM_SNAPSHOT_BLOCK_SIZE + 0x1010] = 7
+    machine.qemu.registers["pc"] = 0x2000
+    panda.writes.clear()
+
+    info = pool.restore("a", None)
+    assert info["peripherals"]["fifo"] == [0] * 0x2000
+    # the page of each changed block
+    assert panda.writes == [RAM_SNAPSHOT_BLOCK_SIZE, 2 * RAM_SNAPSHOT_BLOCK_SIZE + 0x1000]
+    assert not any(panda.mem[:0x50000])
+    assert machine.qemu.registers["pc"] == 0x1000
+    assert panda.flushes == 1
+
+
+def test_pool_evicts_least_recently_used():
+    pool = RamSnapshotPool(FakeMachine(), 2)
+
+    assert pool_take(pool, "a", 1)
+    assert pool_take(pool, "b", 2)
+    assert pool.restore("a", None) is not None
+    assert pool_take(pool, "c", 3)
+
+    assert list(pool.snapshots) == ["a", "c"]
+    # b's peripheral buffer went with it
+    assert set(pool.blob_store.blobs) == (
+        pool.snapshots["a"].digests | pool.snapshots["c"].digests
+    )
+    assert len(pool.blob_store.blobs) == 2
+
+
+def test_pool_restore_failure_leaves_machine():
+    machine = FakeMachine()
+    pool = RamSnapshotPool(machine, 1)
+
+    assert pool_take(pool, "a")
+    pool.blob_store.blobs.clear()
+    machine.panda.mem[0x10] = 1
+    machine.panda.writes.clear()
+
+    assert pool.restore("a", None) is None
+    assert machine.panda.writes == []
+    assert machine.qemu.writes == 0
+    assert machine.panda.mem[0x10] == 1
@@ -0,0 +1,121 @@
+import sys
+from pathlib import Path
+sys.path.append(str(Path(__file__).parent.parent))
+
+from firmwire.util.symbol import SymbolTable
+
+
+def mapped_table(tmp_path, symbols):
+    src = SymbolTable()
+
+    for name, address, size in symbols:
+        src.add(name, address, size=size)
+
+    path = str(tmp_path / "test.symdb")
+    src.save_binary(path)
+
+    table = SymbolTable()
+    table.load_binary(path)
+    return table
+
+
+def test_set_replaces_mapped(tmp_path):
+    table = mapped_table(tmp_path, [("a", 0x1000, 0), ("b", 0x2000, 0)])
+    assert table.lookup("a").address == 0x1000
+
+    table.set("a", 0x3000)
+    assert table.lookup("a").address == 0x3000
+    assert [sym.address for sym in table._lookup_by_name("a", single=False)] == [0x3000]
+    assert table.lookup("b").address == 0x2000
+
+    table.replace("b", 0x4000)
+    assert table.lookup("b").address == 0x4000
+    # the mapped symbols are gone for address lookups as well
+    assert [(sym.name, sym.address) for sym in table.symbols] == [
+        ("a", 0x3000),
+        ("b", 0x4000),
+    ]
+
+
+def test_add_after_mapped(tmp_path):
+    table = mapped_table(tmp_path, [("a", 0x1000, 0)])
+
+    table.add("a", 0x5000)
+    # like a loaded table, the first symbol of a name wins
+    assert table.lookup("a").address == 0x1000
+    assert len(table._lookup_by_name("a", single=False)) == 2
+
+
+def test_add_many_after_mapped(tmp_path):
+    table = mapped_table(
+        tmp_path, [("s%d" % i, 0x10 * i, 0) for i in range(10)]
+    )
+
+    # large enough to rebuild the blocks
+    table.add_many([("n%d" % i, 0x1000 + 0x10 * i) for i in range(5)])
+    assert len(table) == 15
+    assert len(table.symbols) == 15
+    assert table.lookup(0x1020).name == "n2"
+
+    table.remove("s1")
+    assert len(table) == 14
+    assert table.lookup(0x10).name == "s0"
+    assert [sym.name for sym in table.symbols].count("s1") == 0
+
+    table.set("s2", 0x2000)
+    assert len(table) == 14
+    assert [sym.address for sym in table._lookup_by_name("s2", single=False)] == [
+        0x2000
+    ]
+    assert table.lookup(0x20).name == "s0"
+
+
+def test_lookup_containing_edges():
+    table = SymbolTable()
+    table.add("outer", 0x1000, size=0x100)
+    table.add("inner", 0x1040, size=0x20)
+    table.add("left", 0x2000, size=0x10)
+    table.add("right", 0x2010, size=0x10)
+    table.add("first", 0x3000, size=0x20)
+    table.add("second", 0x3010, size=0x30)
+    table.add("label", 0x4000)
+
+    expected = {
+        0xFFF: None,
+        0x1000: "outer",
+        0x103F: "outer",
+        0x1040: "inner",
+        0x105F: "inner",
+        0x1060: "outer",
+        0x10FF: "outer",
+        0x1100: None,
+        0x200F: "left",
+        0x2010: "right",
+        0x2020: None,
+        0x300F: "first",
+        # partially overlapping symbols: the later one wins
+        0x3010: "second",
+        0x301F: "second",
+        0x303F: "second",
+        0x3040: None,
+        0x4000: None,
+    }
+
+    for address, name in expected.items():
+        sym = table.lookup_containing(address)
+        assert (sym.name if sym else None) == name, hex(address)
+
+    addresses = list(expected)[::-1]
+    syms = table.lookup_containing_many(addresses)
+    assert [sym.name if sym else None for sym in syms] == [
+        expected[address] for address in addresses
+    ]
+
+    # symbols without a size are only used near their address
+    syms = table.symbolize_many([0x4000, 0x4FFF, 0x5000, 0x1050])
+    assert [sym.name if sym else None for sym in syms] == [
+        "label",
+        "label",
+        None,
+        "inner",
+    ]